@@ -4,6 +4,8 @@ from collections import deque
 import os
 from timeit import default_timer as timer
 from sklearn import svm
+from numpy.lib.stride_tricks import sliding_window_view
+import numpy as np
 import pickle
 
 def loaddump(filename):
@@ -38,6 +40,20 @@ def get_svt_segments(nr_fingerprints, start, end, database_name="svtplay_db.csv"
 
 
 
+def normalize_windows(windows, minlength):
+    """
+    Normalizes every row of a matrix of windows so that all values are in the range [-2,2],
+    and pads the rows with zeros to *minlength*. Flat windows are normalized to zeros.
+    """
+    windows = np.asarray(windows, dtype=np.float64)
+    xmin = windows.min(axis=1, keepdims=True)
+    span = windows.max(axis=1, keepdims=True) - xmin
+    normalized = np.zeros((len(windows), max(windows.shape[1], minlength)))
+    np.divide(4 * (windows - xmin), span, out=normalized[:, :windows.shape[1]], where=span > 0)
+    normalized[:, :windows.shape[1]] -= 2 * (span > 0)
+    return normalized
+
+
 def normalize_data(x0, minlength):
     """
     Normalizes a window of segments so that all values are in the range [-2,2] to
@@ -45,21 +61,30 @@ def normalize_data(x0, minlength):
 
     https://towardsai.net/p/data-science/how-when-and-why-should-you-normalize-standardize-rescale-your-data-3f083def38ff
     """
-    xmin, xmax = min(x0), max(x0)
-    return [-2 + 4 * (x - xmin) / (xmax - xmin) for x in x0] + [0] * max(0, minlength - len(x0))
+    return normalize_windows([list(x0)], minlength)[0]
 
 
 def create_windows(stream, size, minwidth):
     """
-    Creates, and normalizes, windows of size *size* from the given stream
+    Creates, and normalizes, windows of size *size* from the given stream as rows of a matrix
+    """
+    if len(stream) < size:
+        return np.empty((0, max(size, minwidth)))
+    return normalize_windows(sliding_window_view(np.asarray(stream), size), minwidth)
+
+
+def create_training_data(video_segments, window_width):
+    """
+    Creates the normalized windows of all videos as one matrix and the id of the video of every window
     """
-    ret_list = []
-    window = deque(maxlen=size)
-    for segment in stream:
-        window.append(segment)
-        if(len(window) == size):
-            ret_list.append(normalize_data(window, minwidth))
-    return ret_list
+    windows, ids = [], []
+    for video, stream in video_segments.items():
+        if len(stream) >= window_width:
+            windows.append(sliding_window_view(np.asarray(stream), window_width))
+            ids.append(np.full(len(windows[-1]), video[2]))
+    if not windows:
+        return np.empty((0, window_width)), np.empty(0, dtype=str)
+    return normalize_windows(np.concatenate(windows), window_width), np.concatenate(ids)
 
 
 class SvmLearner:
@@ -79,29 +104,19 @@ class SvmLearner:
         self.window_width = window_width
         video_segments = get_svt_segments(nr_fingerprints, fingerprint_start, fingerprint_end)
 
-        self.db = self.load_svm_db(video_segments)  # format of db: video title + resolution (0), windows (>=1)
+        self.X_train, self.Y_train = self.load_svm_db(video_segments)  # windows and the ids of their videos
         self.learn(nr_fingerprints)
 
     def load_svm_db(self, video_segments):
         """
-        Create list containing the video name and the associated start of the fingerprint
+        Create the matrix of windows of the fingerprints and the id of the video of every window
         """
-        db = []
-        min_windows = -1                            # only for printing
-        max_windows = 0                             # only for printing
-        # adds video title and sliding windows to db
-        for video, stream in video_segments.items():
-            windows = create_windows(stream, self.window_width, self.window_width)
-            if len(windows)                  > max_windows: max_windows=len(windows)    # only for printing
-            if min_windows<0 or len(windows) < min_windows: min_windows=len(windows)    # only for printing
-            for window in windows:
-                db.append([video[2], window])       # only use the id of the video
-
-        t = [tuple(item[1]) for item in db]     # check if duplicates
-        print("len as set: ", len(set(t)))
-        print("Max number of windows for a fingerprint: ", max_windows)
-        print("Min number of windows for a fingerprint: ", min_windows)
-        return db
+        windows, ids = create_training_data(video_segments, self.window_width)
+        windows_per_video = [max(0, len(stream) - self.window_width + 1) for stream in video_segments.values()]   # only for printing
+        print("len as set: ", len(np.unique(windows, axis=0)))     # check if duplicates
+        print("Max number of windows for a fingerprint: ", max(windows_per_video, default=0))
+        print("Min number of windows for a fingerprint: ", min(windows_per_video, default=-1))
+        return windows, ids
 
     def learn(self, videos_to_load):
         """
@@ -120,15 +135,21 @@ class SvmLearner:
         """
         return self.clf.predict([normalize_data(window, self.window_width)])[0]       # normalise the input data
 
+    def predict_many(self, windows) -> np.ndarray:
+        """
+        Uses windows of segments of the same width to predict which video title each belongs to
+        """
+        windows = [list(window) for window in windows]
+        if not windows:
+            return np.empty(0, dtype=str)
+        return self.clf.predict(normalize_windows(windows, self.window_width))
+
     def generate_training_datasets(self):
         """
-        Generates training data (windows) and target label (video title with resolution used)
+        Reports the training data (windows) and target label (video title with resolution used)
         """
-        self.X_train = [window[1] for window in self.db]            # all of the windows for training as individual points
-        print("points in SVM: ", len(self.X_train))
-        
-        self.Y_train = [window[0] for window in self.db]            # all of the classes for the windows
-        print("classes in SVM: ", len(set(self.Y_train)))
+        print("points in SVM: ", len(self.X_train))                 # all of the windows for training as individual points
+        print("classes in SVM: ", len(set(self.Y_train)))           # all of the classes for the windows
 
 
 
@@ -149,4 +170,13 @@ class PreloadedSVM:
         """
         return self.clf.predict([normalize_data(window, self.window_width)])[0]       # normalise the input data
 
+    def predict_many(self, windows) -> np.ndarray:
+        """
+        Uses windows of segments of the same width to predict which video title each belongs to
+        """
+        windows = [list(window) for window in windows]
+        if not windows:
+            return np.empty(0, dtype=str)
+        return self.clf.predict(normalize_windows(windows, self.window_width))
+
     
\ No newline at end of file
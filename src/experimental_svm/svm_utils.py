@@ -1,8 +1,9 @@
 from collections import deque
 import os
 import csv
-from create_svm import SvmLearner
+from create_svm import SvmLearner, create_windows, create_training_data
 import pickle
+import numpy as np
 from dataclasses import dataclass
 
 
@@ -121,9 +122,8 @@ def loaddump(filename):
 def run_predictions(db, xs, ys):
     """Runs predictions using the svm nad the xs and ys provided
     """
-    nr_matches=0                                           # the number of correctly predicted videos
-    for window, vid_id in zip(xs, ys): # run predictions on every stream
-        if db.predict(window) == vid_id: nr_matches+=1
+    predictions = db.predict_many(xs)                      # run predictions on every stream at once
+    return int(np.sum(predictions == np.asarray(ys)))      # the number of correctly predicted videos
 
 
 def load_svm_db(self, video_segments):
@@ -148,50 +148,16 @@ def load_svm_db(self, video_segments):
         return db
 
 
-def normalize_data(x0, minlength):
-    """
-    Normalizes a window of segments so that all values are in the range [-2,2] to
-    get the weight of the segments to have the same influence on the SVM
-
-    https://towardsai.net/p/data-science/how-when-and-why-should-you-normalize-standardize-rescale-your-data-3f083def38ff
-    """
-    xmin, xmax = min(x0), max(x0)
-    return [-2 + 4 * (x - xmin) / (xmax - xmin) for x in x0] + [0] * max(0, minlength - len(x0))
-
-
-def create_windows(stream, size, minwidth):
-    """
-    Creates, and normalizes, windows of size *size* from the given stream
-    """
-    ret_list = []
-    window = deque(maxlen=size)
-    for segment in stream:
-        window.append(segment)
-        if(len(window) == size):
-            ret_list.append(normalize_data(window, minwidth))
-    return ret_list
-
-
 def get_db(window_width, video_segments):
         """
-        Create list containing the video name and the associated start of the fingerprint
+        Create the matrix of windows of the fingerprints and the id of the video of every window
         """
-        db = []
-        min_windows = -1                            # only for printing
-        max_windows = 0                             # only for printing
-        # adds video title and sliding windows to db
-        for video, stream in video_segments.items():
-            windows = create_windows(stream, window_width, window_width)
-            if len(windows)                  > max_windows: max_windows=len(windows)    # only for printing
-            if min_windows<0 or len(windows) < min_windows: min_windows=len(windows)    # only for printing
-            for window in windows:
-                db.append([video[2], window])       # only use the id of the video
-
-        t = [tuple(item[1]) for item in db]     # check if duplicates
-        print("len as set: ", len(set(t)))
-        print("Max number of windows for a fingerprint: ", max_windows)
-        print("Min number of windows for a fingerprint: ", min_windows)
-        return db
+        windows, ids = create_training_data(video_segments, window_width)
+        windows_per_video = [max(0, len(stream) - window_width + 1) for stream in video_segments.values()]   # only for printing
+        print("len as set: ", len(np.unique(windows, axis=0)))     # check if duplicates
+        print("Max number of windows for a fingerprint: ", max(windows_per_video, default=0))
+        print("Min number of windows for a fingerprint: ", min(windows_per_video, default=-1))
+        return windows, ids
 
 @dataclass
 class Training_Data():
@@ -204,11 +170,10 @@ class Training_Data():
         start=fing_start,
         end=fing_end
     )
-    database = get_db(
+    X_train, Y_train = get_db(
         window_width=window_width,
         video_segments=video_segments
     )
-    X_train, Y_train = [window[1] for window in database], [window[0] for window in database]
 
 
 
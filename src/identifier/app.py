@@ -1,28 +1,83 @@
 from flask import Flask, render_template, Response, request, jsonify
-import queue
+from collections import deque
+from threading import Lock, Condition
 import json
-from utils import format
+from time import perf_counter
+import subscriptions
+from utils import format, metrics
+
+FANOUT_TIME = metrics.registry.histogram('web_fanout_seconds',
+    "Time spent handing a broadcast to all subscribers")
+BROADCASTS = metrics.registry.counter('web_broadcasts_total',
+    "Broadcast messages")
+
+class Subscription:
+    """A client's message buffer. Putting never blocks, getting blocks
+    until a message is available. The replayed history is sent first and
+    is never dropped by the buffer's policy.
+    """
+    def __init__(self, buffer, replay=()):
+        self._buffer = buffer
+        self._replay = deque(replay)
+        self._ready = Condition()
+
+    def put(self, flow, msg):
+        with self._ready:
+            self._buffer.put(flow, msg)
+            self._ready.notify()
+
+    def get(self):
+        with self._ready:
+            while not self._replay and not self._buffer:
+                self._ready.wait()
+            if self._replay:
+                return self._replay.popleft()
+            return self._buffer.pop()
+
+    @property
+    def dropped(self):
+        return self._buffer.dropped
 
 class Broadcaster:
     def __init__(self):
         self.subscriptions = []
+        self.history = subscriptions.History()
+        self._lock = Lock()
+
+    def subscribe(self, policy=None):
+        """Return a blocking message queue to a client, primed with the
+        recent history.
+        """
+        buffer = subscriptions.create_buffer(policy)
+        with self._lock:
+            subscription = Subscription(buffer, (sse_msg for _, sse_msg
+                                                 in self.history.replay()))
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscriptions.remove(subscription)
 
-    def subscribe(self):
-        """Return a blocking message queue to a client"""
-        msg_queue = queue.Queue(maxsize=3)
-        self.subscriptions.append(msg_queue)
-        return msg_queue
-    
     def broadcast_sse(self, msg):
-        """Broadcast a message to all subscribing clients."""
-        sse_msg = format.format_sse(data=json.dumps(msg))
+        """Broadcast a message to all subscribing clients. Clients who are
+        not consuming messages lose messages according to their policy.
+        """
+        self.broadcast_many((msg,))
 
-        for i in reversed(range(len(self.subscriptions))):
-            try:
-                self.subscriptions[i].put_nowait(sse_msg)
-            # Remove clients who are not consuming messages
-            except queue.Full:
-                del self.subscriptions[i]
+    def broadcast_many(self, msgs):
+        """Broadcast several messages in order, holding the lock once."""
+        encoded = [(subscriptions.flow_of(msg),
+                    format.format_sse(data=json.dumps(msg))) for msg in msgs]
+
+        with self._lock:
+            for flow, sse_msg in encoded:
+                start = perf_counter()
+                self.history.add(flow, sse_msg)
+                for subscription in self.subscriptions:
+                    subscription.put(flow, sse_msg)
+                FANOUT_TIME.observe(perf_counter() - start)
+                BROADCASTS.inc()
 
 app = Flask(__name__)
 broadcaster = Broadcaster()
@@ -31,19 +86,54 @@ broadcaster = Broadcaster()
 def index():
     if request.method == 'POST':
         data = request.json
+        if not isinstance(data, dict):
+            return jsonify({"Status": "Expected a message object"}), 400
         broadcaster.broadcast_sse(data)
         return jsonify({"Status": "OK"})
     else:
         return render_template('index.html')
 
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Broadcast an array of messages posted in one request."""
+    data = request.json
+    # Checked before any message is sent, a batch is sent whole or not
+    if not (isinstance(data, list) and
+            all(isinstance(msg, dict) for msg in data)):
+        return jsonify({"Status": "Expected an array of message objects"}), 400
+    broadcaster.broadcast_many(data)
+    return jsonify({"Status": "OK", "Received": len(data)})
+
+# Latest metrics pushed by a separate identifier process
+identifier_metrics = ''
+
+@app.route('/metrics', methods=['GET', 'POST'])
+def get_metrics():
+    """Counters and latency histograms in the Prometheus text format, those
+    of the web app followed by those last pushed by the identifier.
+    """
+    global identifier_metrics
+    if request.method == 'POST':
+        identifier_metrics = request.get_data(as_text=True)
+        return jsonify({"Status": "OK"})
+    return Response(metrics.registry.render() + identifier_metrics,
+                    mimetype='text/plain; version=0.0.4')
+
 @app.route('/subscribe', methods=['GET'])
 def subscribe():
     """Subscribe to messages from the broadcaster."""
+    try:
+        subscription = broadcaster.subscribe(request.args.get('policy'))
+    except ValueError as e:
+        return jsonify({"Status": str(e)}), 400
+
     def stream():
-        msg_queue = broadcaster.subscribe()
-        while True:
-            # Block until a new message arrives
-            sse_msg = msg_queue.get()
-            yield sse_msg
+        try:
+            while True:
+                # Block until a new message arrives
+                sse_msg = subscription.get()
+                yield sse_msg
+        finally:
+            broadcaster.unsubscribe(subscription)
 
     return Response(stream(), mimetype='text/event-stream')
@@ -0,0 +1,290 @@
+"""Long-lived identification daemon. Loads the index once and serves
+identification requests over a Unix domain socket, so that the identifier
+and the tests can query it without building an IdentificationDB of their
+own.
+
+Every message is a frame of a little-endian uint32 length and a payload.
+Requests start with an operation, a window count, a window width and a
+Pearson's r threshold followed by the windows as int64 segment sizes.
+Responses start with a status byte, matches are sent as positions with
+their video time, Pearson's r and name.
+"""
+
+from utils.console import console
+from threading import Lock
+from timeit import default_timer as timer
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import numpy as np
+
+DEFAULT_SOCKET = '/tmp/svtplay_identifier.sock'
+
+LOCATE = 1
+VERIFY = 2
+STATS = 3
+
+OK = 0
+ERROR = 1
+
+FRAME = struct.Struct('<I')
+REQUEST = struct.Struct('<BIId')
+STATUS = struct.Struct('<B')
+COUNT = struct.Struct('<I')
+MATCH = struct.Struct('<iidd')
+STRING = struct.Struct('<H')
+POSITION = struct.Struct('<ii')
+
+class IdentificationDaemon:
+    """Answers requests with a single IdentificationDB, one at a time."""
+    def __init__(self, identification_db):
+        self._db = identification_db
+        self._lock = Lock()
+        self._started = timer()
+        self._requests = 0
+        self._windows = 0
+
+    def handle(self, payload):
+        try:
+            op, count, width, threshold = REQUEST.unpack_from(payload, 0)
+            offset = REQUEST.size
+            windows = np.frombuffer(payload, dtype='<i8', count=count*width,
+                                    offset=offset).reshape(count, width)
+            offset += windows.nbytes
+            with self._lock:
+                self._requests += 1
+                self._windows += count
+                if op == LOCATE and width == self._db.window_width:
+                    results = self._db.locate_many(windows.tolist(),
+                                                   threshold)
+                    return STATUS.pack(OK) + _pack_results(results)
+                if op == LOCATE:
+                    results = [self._db.locate(window, threshold)
+                               for window in windows.tolist()]
+                    return STATUS.pack(OK) + _pack_results(results)
+                if op == VERIFY:
+                    positions, _ = _unpack_positions(payload, offset)
+                    results = [self._db.verify(window, positions, threshold)
+                               for window in windows.tolist()]
+                    return STATUS.pack(OK) + _pack_results(results)
+                if op == STATS:
+                    return STATUS.pack(OK) + json.dumps(self.stats()).encode()
+            raise ValueError(f"unknown operation {op}")
+        except Exception as e:
+            # A bad request is answered with an error, never ends the client
+            return STATUS.pack(ERROR) + \
+                f"{type(e).__name__}: {e}".encode()
+
+    def stats(self):
+        return {
+            'Window width': self._db.window_width,
+            'K-dimension': self._db.k_dimension,
+            'Prefix widths': list(self._db.prefix_widths),
+            'Videos': len(self._db.videos),
+            'Uptime': round(timer() - self._started, 1),
+            'Requests': self._requests,
+            'Windows': self._windows,
+            'Cache': self._db.cache_stats()}
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                payload = _recv_frame(self.request)
+            except ConnectionError:
+                return
+            _send_frame(self.request, self.server.daemon.handle(payload))
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(identification_db, socket_path=DEFAULT_SOCKET):
+    """Serve requests on the socket until interrupted."""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with _Server(socket_path, _Handler) as server:
+        server.daemon = IdentificationDaemon(identification_db)
+        console.log(f"Identification daemon listening on {socket_path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+class IdentificationClient:
+    """Queries an identification daemon with the same interface as
+    IdentificationDB for identify, locate and verify.
+    """
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        info = self.stats()
+        self._window_width = info['Window width']
+        self._k = info['K-dimension']
+        self._prefix_widths = tuple(info['Prefix widths'])
+
+    def identify(self, captured_window, pearson_threshold=0.99):
+        return [match for match, _ in self.locate(captured_window,
+                                                  pearson_threshold)]
+
+    def identify_many(self, captured_windows, pearson_threshold=0.99):
+        """Identifies windows of the same width in one request."""
+        return [[match for match, _ in located] for located
+                in self._request(LOCATE, captured_windows, pearson_threshold)]
+
+    def locate(self, captured_window, pearson_threshold=0.99):
+        return self._request(LOCATE, [captured_window], pearson_threshold)[0]
+
+    def verify(self, captured_window, positions, pearson_threshold=0.99):
+        return self._request(VERIFY, [captured_window], pearson_threshold,
+                             _pack_positions(positions))[0]
+
+    def stats(self):
+        """Health and statistics of the daemon."""
+        return json.loads(self._send(REQUEST.pack(STATS, 0, 0, 0)))
+
+    def close(self):
+        self._socket.close()
+
+    @property
+    def window_width(self):
+        return self._window_width
+
+    @property
+    def k_dimension(self):
+        return self._k
+
+    @property
+    def prefix_widths(self):
+        return self._prefix_widths
+
+    def _request(self, op, captured_windows, pearson_threshold, extra=b''):
+        windows = np.array([list(window) for window in captured_windows],
+                           dtype='<i8')
+        count, width = windows.shape
+        payload = (REQUEST.pack(op, count, width, pearson_threshold) +
+                   windows.tobytes() + extra)
+        return _unpack_results(self._send(payload))
+
+    def _send(self, payload):
+        _send_frame(self._socket, payload)
+        response = _recv_frame(self._socket)
+        status, = STATUS.unpack_from(response, 0)
+        if status != OK:
+            raise ValueError(response[STATUS.size:].decode())
+        return response[STATUS.size:]
+
+def _send_frame(sock, payload):
+    sock.sendall(FRAME.pack(len(payload)) + payload)
+
+def _recv_frame(sock):
+    length, = FRAME.unpack(_recv_exactly(sock, FRAME.size))
+    return _recv_exactly(sock, length)
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+def _pack_string(string):
+    encoded = string.encode()
+    return STRING.pack(len(encoded)) + encoded
+
+def _unpack_string(payload, offset):
+    length, = STRING.unpack_from(payload, offset)
+    offset += STRING.size
+    return payload[offset:offset + length].decode(), offset + length
+
+def _pack_positions(positions):
+    return COUNT.pack(len(positions)) + b''.join(
+        _pack_string(video_id) + POSITION.pack(fingerprint_index,
+                                               window_index)
+        for video_id, fingerprint_index, window_index in positions)
+
+def _unpack_positions(payload, offset):
+    count, = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    positions = []
+    for _ in range(count):
+        video_id, offset = _unpack_string(payload, offset)
+        fingerprint_index, window_index = POSITION.unpack_from(payload,
+                                                               offset)
+        offset += POSITION.size
+        positions.append((video_id, fingerprint_index, window_index))
+    return positions, offset
+
+def _pack_results(results):
+    """Packs a list of (match, position) lists, one per window."""
+    parts = [COUNT.pack(len(results))]
+    for located in results:
+        parts.append(COUNT.pack(len(located)))
+        for match, (video_id, fingerprint_index, window_index) in located:
+            parts.append(MATCH.pack(fingerprint_index, window_index,
+                                    match['time'], match['pearsons_r']))
+            parts.append(_pack_string(video_id))
+            parts.append(_pack_string(match['name']))
+    return b''.join(parts)
+
+def _unpack_results(payload):
+    count, = COUNT.unpack_from(payload, 0)
+    offset = COUNT.size
+    results = []
+    for _ in range(count):
+        matches, = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        located = []
+        for _ in range(matches):
+            fingerprint_index, window_index, time, pearsons_r = \
+                MATCH.unpack_from(payload, offset)
+            offset += MATCH.size
+            video_id, offset = _unpack_string(payload, offset)
+            name, offset = _unpack_string(payload, offset)
+            located.append(({
+                'id': video_id,
+                'name': name,
+                'time': time,
+                'pearsons_r': pearsons_r
+                }, (video_id, fingerprint_index, window_index)))
+        results.append(located)
+    return results
+
+if __name__ == "__main__":
+    import db
+    parser = argparse.ArgumentParser(
+        description="Loads the SVT Play index once and serves " +
+            "identification requests over a Unix domain socket.")
+    parser.add_argument('--socket',
+        help="path of the Unix domain socket",
+        default=DEFAULT_SOCKET)
+    parser.add_argument('-w', "--window-width",
+        help="amount of segments in a window",
+        type=int,
+        default=4)
+    parser.add_argument('-k', "--k-dimension",
+        help="dimension used for k-d tree",
+        type=int,
+        default=4)
+    parser.add_argument("--prefix-widths",
+        help="build additional k-d trees for these amounts of segments",
+        type=int,
+        nargs='+',
+        default=())
+    parser.add_argument("--attach-index",
+        help="use the index another identifier published under this " +
+            "name instead of building one")
+    args = parser.parse_args()
+    if args.attach_index:
+        identification_db = db.IdentificationDB.attach(args.attach_index)
+    else:
+        identification_db = db.IdentificationDB(args.window_width,
+            args.k_dimension, prefix_widths=args.prefix_widths)
+    try:
+        serve(identification_db, args.socket)
+    except KeyboardInterrupt:
+        print("Quitting daemon...")
@@ -1,111 +1,652 @@
-from utils.console import console
-from collections import deque
-import sklearn.neighbors
-import scipy
+from utils.console import console, progress
+from utils import metrics, format
+from collections import deque, OrderedDict
+from itertools import chain
+from multiprocessing import shared_memory, resource_tracker
+from time import perf_counter
 import numpy as np
 import csv
+import math
+import pickle
+import struct
 from os import path
 
+# Candidates below this Pearson's r do not vote for an alignment
+VOTE_MIN_R = 0.99
+CACHE_SIZE = 4096
+# Bytes the segment sizes of a window are rounded to for the cache key, 1
+# only serves exact repeats of a window from the cache
+CACHE_QUANTUM = 1
+LEAF_SIZE = 400
+NEIGHBOR_AMOUNT = 5
+
+# Shared index layout: a header with the offset and length of the pickled
+# manifest, followed by the arrays and the manifest
+SHARED_HEADER = struct.Struct('<QQ')
+SHARED_ALIGNMENT = 64
+
+KD_KEY_TIME = metrics.registry.histogram('identifier_kd_key_seconds',
+    "Time spent creating the k-d key of a captured window")
+KD_QUERY_TIME = metrics.registry.histogram('identifier_kd_query_seconds',
+    "Time spent querying the k-d tree")
+PEARSON_TIME = metrics.registry.histogram('identifier_pearson_seconds',
+    "Time spent verifying the nearest neighbors with Pearson's r")
+WINDOWS = metrics.registry.counter('identifier_windows_total',
+    "Captured windows identified")
+TRACKED_WINDOWS = metrics.registry.counter('identifier_tracked_windows_total',
+    "Captured windows verified against the positions of earlier matches")
+MATCHES = metrics.registry.counter('identifier_matches_total',
+    "Neighbors matching a captured window")
+CACHE_HITS = metrics.registry.counter('identifier_cache_hits_total',
+    "Windows identified from the result cache")
+CACHE_MISSES = metrics.registry.counter('identifier_cache_misses_total',
+    "Windows not found in the result cache")
+NEAR_THRESHOLD = metrics.registry.counter('identifier_near_threshold_total',
+    "Neighbors with a Pearson's r within a decade of the threshold")
+
 class IdentificationDB:
     """Instantiation of this class loads the fingerprint db and creates
     the kd tree. Call the identify function with a captured window
     to determine a match.
     """
-    def __init__(self, window_width=12, k_dimension=6, csv_db=None):
+    def __init__(self, window_width=12, k_dimension=6, csv_db=None,
+                 prefix_widths=(), cache_size=CACHE_SIZE,
+                 cache_quantum=CACHE_QUANTUM,
+                 leaf_size=LEAF_SIZE, neighbor_amount=NEIGHBOR_AMOUNT,
+                 quiet=False):
+
+        for prefix_width in prefix_widths:
+            if not 3 <= prefix_width < window_width:
+                raise ValueError("prefix widths have to be at least 3 and " +
+                    "smaller than the window width!")
 
         self._window_width = window_width
         self._k = k_dimension
-        self._videos = csv_db if csv_db is not None else load_csv_db()
-        self._kd_tree = self._kd_tree_build()
+        self._prefix_widths = tuple(prefix_widths)
+        self._leaf_size = leaf_size
+        # Log progress instead of showing a status, e.g. off the main thread
+        self._quiet = quiet
+        # Nearest neighbors verified per window, may be changed at any time
+        self.neighbor_amount = neighbor_amount
+        self._videos = (csv_db if csv_db is not None
+                        else load_csv_db(quiet))
+        self._build_indexes()
+        self._init_cache(cache_size, cache_quantum)
+
+    def _init_cache(self, cache_size, cache_quantum):
+        # Results of recent windows, captured windows are rounded to the
+        # cache quantum so that windows differing by a few bytes share them
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_quantum = cache_quantum
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _build_indexes(self):
+        self._kd_tree, self.tree_index_to_window = self._kd_tree_build(
+            self._window_width, self._k)
+
+        # Smaller k-d trees for the first segments of a stream, sharing the
+        # fingerprints with the full width tree
+        self._prefix_indexes = {}
+        for prefix_width in self._prefix_widths:
+            prefix_k = prefix_dimension(prefix_width, self._k)
+            self._prefix_indexes[prefix_width] = (
+                *self._kd_tree_build(prefix_width, prefix_k), prefix_k)
+
+    def share(self, name):
+        """Publishes the k-d trees, their neighbor mappings and the
+        fingerprints in shared memory, for identifiers in other processes
+        to attach to. Returns the SharedMemory, which has to stay open while
+        it is in use and should be unlinked afterwards.
+        """
+        video_ids = list(self._videos)
+        video_numbers = {video_id: i for i, video_id in enumerate(video_ids)}
+        fingerprints = [fingerprint for video_id in video_ids for fingerprint
+                        in self._videos[video_id]['fingerprints']]
+        lengths = [len(fingerprint) for fingerprint in fingerprints]
+        arrays = {
+            'segments': np.fromiter(chain.from_iterable(fingerprints),
+                                    dtype=np.int64, count=sum(lengths)),
+            'fingerprint_offsets': np.cumsum([0] + lengths, dtype=np.int64)}
+
+        indexes = {self._window_width: (self._kd_tree,
+                                        self.tree_index_to_window, self._k)}
+        indexes.update(self._prefix_indexes)
+        tree_states = {}
+        for window_width, (kd_tree, tree_index_to_window, k) in \
+                indexes.items():
+            state = kd_tree.__getstate__()
+            for i, part in enumerate(state):
+                if isinstance(part, np.ndarray):
+                    arrays[f'tree_{window_width}_{i}'] = part
+            arrays[f'positions_{window_width}'] = np.array(
+                [(video_numbers[video_id], fingerprint_index, window_index)
+                 for video_id, fingerprint_index, window_index
+                 in (tree_index_to_window[i]
+                     for i in range(len(tree_index_to_window)))],
+                dtype=np.int64).reshape(-1, 3)
+            tree_states[window_width] = (k, [
+                None if isinstance(part, np.ndarray) else part
+                for part in state])
 
-    def _kd_tree_build(self):
+        layout = {}
+        offset = SHARED_ALIGNMENT
+        for key, array in arrays.items():
+            layout[key] = (array.dtype, array.shape, offset)
+            offset += -(-array.nbytes // SHARED_ALIGNMENT) * SHARED_ALIGNMENT
+        manifest = pickle.dumps({
+            'window_width': self._window_width,
+            'k': self._k,
+            'prefix_widths': self._prefix_widths,
+            'leaf_size': self._leaf_size,
+            'videos': [(video_id, self._videos[video_id]['name'],
+                        self._videos[video_id]['duration'],
+                        self._videos[video_id]['segment_length'],
+                        len(self._videos[video_id]['fingerprints']))
+                       for video_id in video_ids],
+            'tree_states': tree_states,
+            'layout': layout})
+
+        shm = shared_memory.SharedMemory(name=name, create=True,
+                                         size=offset + len(manifest))
+        SHARED_HEADER.pack_into(shm.buf, 0, offset, len(manifest))
+        shm.buf[offset:offset + len(manifest)] = manifest
+        for key, (dtype, shape, array_offset) in layout.items():
+            shared = np.ndarray(shape, dtype, buffer=shm.buf,
+                                offset=array_offset)
+            shared[...] = arrays[key]
+            del shared
+        console.log(f"Index shared as [bold]{name}[/bold] "
+                    f"({format.convert_size(shm.size)})")
+        return shm
+
+    @classmethod
+    def attach(cls, name, cache_size=CACHE_SIZE, cache_quantum=CACHE_QUANTUM,
+               neighbor_amount=NEIGHBOR_AMOUNT):
+        """Returns an IdentificationDB using the index another process has
+        shared under the given name. Nothing is copied, the k-d trees and
+        fingerprints are read-only views of the shared memory.
+        """
+        shm = _open_shared_memory(name)
+        manifest_offset, manifest_length = SHARED_HEADER.unpack_from(
+            shm.buf, 0)
+        manifest = pickle.loads(
+            shm.buf[manifest_offset:manifest_offset + manifest_length])
+        arrays = {}
+        for key, (dtype, shape, offset) in manifest['layout'].items():
+            arrays[key] = np.ndarray(shape, dtype, buffer=shm.buf,
+                                     offset=offset)
+            arrays[key].flags.writeable = False
+
+        segments = arrays['segments']
+        offsets = arrays['fingerprint_offsets']
+        video_ids = []
+        videos = {}
+        fingerprint_number = 0
+        for video_id, name, duration, segment_length, fingerprint_count in \
+                manifest['videos']:
+            video_ids.append(video_id)
+            videos[video_id] = {
+                'name': name,
+                'duration': duration,
+                'segment_length': segment_length,
+                'fingerprints': tuple(
+                    segments[offsets[i]:offsets[i + 1]] for i in range(
+                        fingerprint_number,
+                        fingerprint_number + fingerprint_count))}
+            fingerprint_number += fingerprint_count
+
+        indexes = {}
+        for window_width, (k, state) in manifest['tree_states'].items():
+            state = tuple(arrays.get(f'tree_{window_width}_{i}', part)
+                          for i, part in enumerate(state))
+            indexes[window_width] = (_restore_kd_tree(state),
+                _SharedWindows(arrays[f'positions_{window_width}'],
+                               video_ids), k)
+
+        identification_db = cls.__new__(cls)
+        identification_db._shared_memory = shm
+        identification_db._window_width = manifest['window_width']
+        identification_db._k = manifest['k']
+        identification_db._prefix_widths = manifest['prefix_widths']
+        identification_db._leaf_size = manifest['leaf_size']
+        identification_db._quiet = False
+        identification_db.neighbor_amount = neighbor_amount
+        identification_db._videos = videos
+        identification_db._kd_tree, identification_db.tree_index_to_window, \
+            _ = indexes.pop(manifest['window_width'])
+        identification_db._prefix_indexes = indexes
+        identification_db._init_cache(cache_size, cache_quantum)
+        console.log(f"Attached to shared index [bold]{shm.name}[/bold] with "
+                    f"{len(videos)} videos")
+        return identification_db
+
+    def update_catalog(self, csv_db=None):
+        """Replaces the fingerprints, reloading the CSV db by default,
+        rebuilds the k-d trees and invalidates the result cache.
+        """
+        self._videos = (csv_db if csv_db is not None
+                        else load_csv_db(self._quiet))
+        self._build_indexes()
+        self._cache.clear()
+
+    def _kd_tree_build(self, window_width, k):
         """Creates all k-d keys for all videos and their fingerprints, maps
         each tree index to its corresponding video id, fingerprint index and
         window index and builds the k-d tree with all keys.
         """
-        with (console.status(f"Creating {self._k}-dimensional keys...")
+        with (progress(f"Creating {k}-dimensional keys...", self._quiet)
               as status):
 
-            self.tree_index_to_window = {}
+            tree_index_to_window = {}
             keys = []
             i = 0
             for video_id, video_data in self._videos.items():
                 for f_i, fingerprint in enumerate(video_data['fingerprints']):
-                    if len(fingerprint) < self._window_width:
+                    if len(fingerprint) < window_width:
                         continue
                     fingerprint_keys = get_kd_keys(
-                        fingerprint, self._window_width, self._k)
+                        fingerprint, window_width, k)
                     for k_i, fingerprint_key in enumerate(fingerprint_keys):
                         keys.append(fingerprint_key)
-                        self.tree_index_to_window[i] = (video_id, f_i, k_i)
+                        tree_index_to_window[i] = (video_id, f_i, k_i)
                         i += 1
 
             console.log(f"{len(keys)} keys created")
 
             status.update("Building k-d tree, give this a moment...")
-            kd_keys = np.zeros(shape=(len(keys), self._k))
+            kd_keys = np.zeros(shape=(len(keys), k))
             for i, key in enumerate(keys):
                 kd_keys[i] = key
-            kd_tree = sklearn.neighbors.KDTree(kd_keys, leaf_size=400)
-            console.log("[bold green]K-d tree[/bold green] "
-                        ":deciduous_tree: built successfully ")
+            # Imported here, scikit-learn takes seconds to load
+            from sklearn.neighbors import KDTree
+            kd_tree = KDTree(kd_keys, leaf_size=self._leaf_size)
+            console.log(f"[bold green]K-d tree[/bold green] "
+                        f":deciduous_tree: for window width {window_width} "
+                        f"built successfully ")
 
-        return kd_tree
+        return kd_tree, tree_index_to_window
 
-    def _get_nearest_neighbors(self, key, neighbor_amount=5):
+    def _get_nearest_neighbors(self, key, neighbor_amount=None, kd_tree=None,
+            tree_index_to_window=None):
         """Returns nearest neighbors in the where each neighbor
         is on the form (video_id, fingerprint_index, window_index).
         """
+        if kd_tree is None:
+            kd_tree = self._kd_tree
+            tree_index_to_window = self.tree_index_to_window
+        if neighbor_amount is None:
+            neighbor_amount = self.neighbor_amount
 
-        tree_indices = self._kd_tree.query([key], k=neighbor_amount,
+        start = perf_counter()
+        tree_indices = kd_tree.query([key], k=neighbor_amount,
             return_distance=False)[0]
+        KD_QUERY_TIME.observe(perf_counter() - start)
 
         # Use tree_indices to get the neighbors
-        return [self.tree_index_to_window[index] for index in tree_indices]
+        return [tree_index_to_window[index] for index in tree_indices]
 
     def _determine_match(self, captured_window, nearest_neighbors,
             pearson_threshold):
-
-        matches = []
+        """Returns (match, position) for every neighbor correlating with the
+        captured window above the threshold.
+        """
+        start = perf_counter()
+        located = []
         for neighbor in nearest_neighbors:
-            video_id, fingerprint_index, window_index = neighbor
-
-            fingerprint = (self._videos[video_id]['fingerprints']
-                           [fingerprint_index])
-
-            # Use index to extract window from segments
-            neighbor_window = (fingerprint[window_index : window_index
-                                           + self._window_width])
-
-            pearsons_r, _ = scipy.stats.pearsonr(captured_window,
-                                                 neighbor_window)
-
-            if pearsons_r > pearson_threshold:
-                name = self._videos[video_id]['name']
-                duration = self._videos[video_id]['duration']
-                segment_length = self._videos[video_id]['segment_length']
-                time = video_time(window_index, len(fingerprint), duration,
-                                      segment_length, self._window_width)
-                matches.append({
-                    'id': video_id,
-                    'name': name,
-                    'time': time,
-                    'pearsons_r': pearsons_r
-                    })
+            match = self._match_at(captured_window, neighbor,
+                                   pearson_threshold)
+            if match is not None:
+                located.append((match, neighbor))
+
+        PEARSON_TIME.observe(perf_counter() - start)
+        MATCHES.inc(len(located))
+        return located
+
+    def _match_at(self, captured_window, position, pearson_threshold):
+        pearsons_r = self._correlate(captured_window, position)
+        if pearsons_r is None:
+            return None
+
+        if _near_threshold(pearsons_r, pearson_threshold):
+            NEAR_THRESHOLD.inc()
+
+        if pearsons_r > pearson_threshold:
+            return self._match(position, pearsons_r, len(captured_window))
+        return None
+
+    def _correlate(self, captured_window, position):
+        """Returns Pearson's r between the captured window and the window at
+        the position, None if the fingerprint ends before the window.
+        Windows shorter than the window width are compared with the start
+        of the window at the position.
+        """
+        video_id, fingerprint_index, window_index = position
+        window_width = len(captured_window)
+
+        fingerprint = (self._videos[video_id]['fingerprints']
+                       [fingerprint_index])
+
+        # Use index to extract window from segments
+        neighbor_window = (fingerprint[window_index : window_index
+                                       + window_width])
+        if len(neighbor_window) < window_width:
+            return None
 
-        return matches
+        from scipy.stats import pearsonr
+        pearsons_r, _ = pearsonr(captured_window, neighbor_window)
+        return pearsons_r
+
+    def _match(self, position, pearsons_r, window_width):
+        video_id, fingerprint_index, window_index = position
+        fingerprint_length = len(self._videos[video_id]['fingerprints']
+                                 [fingerprint_index])
+        name = self._videos[video_id]['name']
+        duration = self._videos[video_id]['duration']
+        segment_length = self._videos[video_id]['segment_length']
+        time = video_time(window_index, fingerprint_length, duration,
+                              segment_length, window_width)
+        return {
+            'id': video_id,
+            'name': name,
+            'time': time,
+            'pearsons_r': pearsons_r
+            }
 
     def identify(self, captured_window, pearson_threshold=0.99):
+        return [match for match, _ in self.locate(captured_window,
+                                                  pearson_threshold)]
+
+    def locate(self, captured_window, pearson_threshold=0.99):
+        """Like identify, but returns (match, position) pairs where position
+        is (video_id, fingerprint_index, window_index) of the matched window.
+        Windows of a prefix width are looked up in the prefix's k-d tree.
+        Recent results are served from a cache before any tree work.
+        """
+        cache_key = self._cache_key(captured_window, pearson_threshold)
+        located = self._cache_get(cache_key)
+        if located is not None:
+            return located
+
+        window_width = len(captured_window)
+        if window_width == self._window_width:
+            kd_tree, tree_index_to_window, k = None, None, self._k
+        elif window_width in self._prefix_indexes:
+            kd_tree, tree_index_to_window, k = \
+                self._prefix_indexes[window_width]
+        else:
+            raise ValueError(f"no index for windows of {window_width} " +
+                "segments!")
+
+        WINDOWS.inc()
+        start = perf_counter()
+        kd_key = create_kd_key(captured_window, window_width, k)
+        KD_KEY_TIME.observe(perf_counter() - start)
+        nearest_neighbors = self._get_nearest_neighbors(kd_key,
+            kd_tree=kd_tree, tree_index_to_window=tree_index_to_window)
+        located = self._determine_match(captured_window, nearest_neighbors,
+                                        pearson_threshold)
+
+        self._cache_put(cache_key, located)
+        return located
+
+    def identify_many(self, captured_windows, pearson_threshold=0.99):
+        """Identifies windows of the window width in one batch."""
+        return [[match for match, _ in located] for located
+                in self.locate_many(captured_windows, pearson_threshold)]
+
+    def locate_many(self, captured_windows, pearson_threshold=0.99):
+        """Like locate for windows of the window width, querying the k-d
+        tree once for all windows missing from the cache.
+        """
+        located = []
+        misses = []
+        for window in captured_windows:
+            if len(window) != self._window_width:
+                raise ValueError("batches have to be windows of " +
+                    f"{self._window_width} segments!")
+            cache_key = self._cache_key(window, pearson_threshold)
+            located.append(self._cache_get(cache_key))
+            if located[-1] is None:
+                misses.append((len(located) - 1, window, cache_key))
+        if not misses:
+            return located
+
+        WINDOWS.inc(len(misses))
+        start = perf_counter()
+        kd_keys = np.reshape([window for _, window, _ in misses],
+            (len(misses), self._k, self._window_width // self._k)).sum(axis=2)
+        KD_KEY_TIME.observe(perf_counter() - start)
+        start = perf_counter()
+        tree_indices = self._kd_tree.query(kd_keys, k=self.neighbor_amount,
+                                           return_distance=False)
+        KD_QUERY_TIME.observe(perf_counter() - start)
+
+        for (i, window, cache_key), indices in zip(misses, tree_indices):
+            nearest_neighbors = [self.tree_index_to_window[index]
+                                 for index in indices]
+            located[i] = self._determine_match(window, nearest_neighbors,
+                                               pearson_threshold)
+            self._cache_put(cache_key, located[i])
+        return located
+
+    def _cache_key(self, captured_window, pearson_threshold):
+        if not self._cache_size:
+            return None
+        quantum = self._cache_quantum
+        return (pearson_threshold, self.neighbor_amount,
+                *(round(segment / quantum) for segment in captured_window))
+
+    def _cache_get(self, cache_key):
+        """Returns the cached result of a window, None if there is none."""
+        if cache_key is None:
+            return None
+        located = self._cache.get(cache_key)
+        if located is None:
+            self.cache_misses += 1
+            CACHE_MISSES.inc()
+            return None
+        self._cache.move_to_end(cache_key)
+        self.cache_hits += 1
+        CACHE_HITS.inc()
+        return list(located)
+
+    def _cache_put(self, cache_key, located):
+        if cache_key is None:
+            return
+        self._cache[cache_key] = tuple(located)
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def verify(self, captured_window, positions, pearson_threshold=0.99):
+        """Returns (match, position) for the given positions that still
+        match the captured window, without querying the k-d tree.
+        """
+        TRACKED_WINDOWS.inc()
+        return self._determine_match(captured_window, positions,
+                                     pearson_threshold)
+
+    def vote(self, captured_window, voting, pearson_threshold=0.99):
+        """Like locate, but also lets the candidates of the window vote on
+        the alignment of the stream. Matches the window if a candidate
+        passes the threshold on its own, or if an alignment has gathered
+        enough evidence over consecutive windows. The result cache is not
+        used, the candidates depend on the alignments voted for so far.
+        """
+        WINDOWS.inc()
+        start = perf_counter()
         kd_key = create_kd_key(captured_window, self._window_width, self._k)
+        KD_KEY_TIME.observe(perf_counter() - start)
         nearest_neighbors = self._get_nearest_neighbors(kd_key)
-        match_or_empty = self._determine_match(captured_window,
-            nearest_neighbors, pearson_threshold)
-        return match_or_empty
+
+        start = perf_counter()
+        candidates = []
+        for position in dict.fromkeys(nearest_neighbors +
+                                      voting.expected_positions()):
+            pearsons_r = self._correlate(captured_window, position)
+            if pearsons_r is not None:
+                if _near_threshold(pearsons_r, pearson_threshold):
+                    NEAR_THRESHOLD.inc()
+                candidates.append((pearsons_r, position))
+        PEARSON_TIME.observe(perf_counter() - start)
+
+        voted = voting.add(candidates)
+        located = [(self._match(position, pearsons_r, self._window_width),
+                    position)
+                   for pearsons_r, position in candidates
+                   if pearsons_r > pearson_threshold or position in voted]
+        MATCHES.inc(len(located))
+        return located
 
     @property
     def videos(self):
         return self._videos
 
+    def index_size(self):
+        """Returns the size in bytes of the arrays of the k-d trees."""
+        kd_trees = [self._kd_tree] + [kd_tree for kd_tree, _, _
+                                      in self._prefix_indexes.values()]
+        return sum(array.nbytes for kd_tree in kd_trees
+                   for array in kd_tree.get_arrays())
+
+    def cache_stats(self):
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'Size': len(self._cache),
+            'Capacity': self._cache_size,
+            'Quantum': self._cache_quantum,
+            'Hits': self.cache_hits,
+            'Misses': self.cache_misses,
+            'Hit rate': self.cache_hits / lookups if lookups else None}
+
+    @property
+    def window_width(self):
+        return self._window_width
+
+    @property
+    def k_dimension(self):
+        return self._k
+
+    @property
+    def prefix_widths(self):
+        return tuple(self._prefix_indexes)
+
+class _SharedWindows:
+    """Maps tree indices to (video_id, fingerprint_index, window_index)
+    from the positions array of a shared index.
+    """
+    def __init__(self, positions, video_ids):
+        self._positions = positions
+        self._video_ids = video_ids
+
+    def __getitem__(self, index):
+        video_number, fingerprint_index, window_index = \
+            self._positions[index]
+        return (self._video_ids[video_number], int(fingerprint_index),
+                int(window_index))
+
+    def __len__(self):
+        return len(self._positions)
+
+class _AttachedMemory(shared_memory.SharedMemory):
+    def __del__(self):
+        # The index arrays are views of the memory until the process exits
+        try:
+            super().__del__()
+        except BufferError:
+            pass
+
+def _open_shared_memory(name):
+    try:
+        return _AttachedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the memory with the
+        # resource tracker, which would unlink it when this process exits
+        shm = _AttachedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def _restore_kd_tree(state):
+    """Returns a k-d tree on the given state without rebuilding it, or a
+    rebuilt copy if this scikit-learn cannot use read-only arrays.
+    """
+    from sklearn.neighbors import KDTree
+    kd_tree = KDTree.__new__(KDTree)
+    try:
+        kd_tree.__setstate__(state)
+    except (ValueError, TypeError):
+        kd_tree = KDTree(np.array(state[0]), leaf_size=state[4])
+    return kd_tree
+
+class EvidenceVoting:
+    """Accumulates the candidates of consecutive windows of a stream.
+    Candidates agreeing on where the stream starts in a fingerprint vote
+    for the same alignment, and an alignment is matched once it has votes
+    from at least two windows and their combined Pearson's r passes the
+    confidence. The r of the votes are combined by averaging their Fisher
+    transforms, weighted by the square root of the vote count.
+    """
+    def __init__(self, confidence, min_r=VOTE_MIN_R):
+        self._confidence = _fisher_z(confidence)
+        self._min_r = min_r
+        self._windows = 0
+        # (video id, fingerprint index, offset) -> (sum of z, votes)
+        self._alignments = {}
+
+    def add(self, candidates):
+        """Adds the (pearsons_r, position) candidates of the next window and
+        returns the positions of the alignments passing the confidence.
+        """
+        alignments = {}
+        for pearsons_r, (video_id, fingerprint_index, window_index) in \
+                candidates:
+            if not pearsons_r >= self._min_r:
+                continue
+            alignment = (video_id, fingerprint_index,
+                         window_index - self._windows)
+            if alignment in alignments:
+                continue
+            z_sum, votes = self._alignments.get(alignment, (0.0, 0))
+            alignments[alignment] = (z_sum + _fisher_z(pearsons_r), votes + 1)
+
+        # Only alignments voted for by the latest window are kept
+        self._alignments = alignments
+        self._windows += 1
+
+        return {(video_id, fingerprint_index, offset + self._windows - 1)
+                for (video_id, fingerprint_index, offset), (z_sum, votes)
+                in alignments.items()
+                if votes > 1 and z_sum / math.sqrt(votes) > self._confidence}
+
+    def skip(self):
+        """Advances past a window that did not vote, e.g. one verified at
+        the tracked positions, keeping the alignments in step with the
+        stream.
+        """
+        self._windows += 1
+
+    def expected_positions(self):
+        """Returns the positions the next window has for every alignment."""
+        return [(video_id, fingerprint_index, offset + self._windows)
+                for video_id, fingerprint_index, offset in self._alignments]
+
+def _fisher_z(pearsons_r):
+    # Clamp to keep a perfect correlation finite
+    return math.atanh(min(pearsons_r, 1 - 1e-15))
+
+def _near_threshold(pearsons_r, pearson_threshold):
+    """Whether 1 - r is within a factor of ten of 1 - threshold, where a
+    small change in the threshold would flip the outcome.
+    """
+    distance = 1 - pearson_threshold
+    return distance / 10 < 1 - pearsons_r < distance * 10
+
+def prefix_dimension(prefix_width, k):
+    """Returns the largest dimension up to k that divides the prefix."""
+    return max(d for d in range(1, min(k, prefix_width) + 1)
+               if prefix_width % d == 0)
+
 def video_time(window_index, fingerprint_length, video_duration,
                    segment_length, window_width, buffer_time=60):
     factor = window_index / fingerprint_length
@@ -139,13 +680,16 @@ def get_kd_keys(fingerprint, window_width, k):
             keys.append(create_kd_key(sliding_window, window_width, k))
     return keys
 
-def load_csv_db():
-    with console.status("Loading database..."):
-        file_path = path.join(path.dirname(path.abspath(__file__)),
-                              'svtplay_db.csv')
-        if not path.exists(file_path):
-            file_path = file_path.replace('.csv', '_intl.csv')
-        with open(file_path, encoding='utf8') as file:
+def csv_db_path():
+    file_path = path.join(path.dirname(path.abspath(__file__)),
+                          'svtplay_db.csv')
+    if not path.exists(file_path):
+        file_path = file_path.replace('.csv', '_intl.csv')
+    return file_path
+
+def load_csv_db(quiet=False):
+    with progress("Loading database...", quiet):
+        with open(csv_db_path(), encoding='utf8') as file:
             videos = {}
             reader = csv.reader(file)
             for row in reader:
@@ -1,7 +1,12 @@
 from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Event, Lock
 import argparse
-from utils import format, network
-import requests
+import json
+import queue
+from utils import format, network, metrics, profiling
+from contextlib import nullcontext
+from time import perf_counter, monotonic
 import db
 from utils.console import console
 
@@ -10,88 +15,440 @@ TLS_OVERHEAD = 1.0018
 SEGMENT_TIME_THRESHOLD = 2
 MIN_SEGMENT_SIZE = 5000
 MAX_SEGMENT_SIZE = 9000000
+WEB_SERVER_URL = 'http://localhost:5000'
+METRICS_INTERVAL = 60
+METRICS_PUSH_INTERVAL = 5
 
-def run(interface, cli, window_width, k, pearson_threshold, full_cdn_search):
+PARSE_TIME = metrics.registry.histogram('identifier_packet_parse_seconds',
+    "Time spent parsing a captured packet")
+SEGMENT_TIME = metrics.registry.histogram('identifier_segment_seconds',
+    "Time spent assembling a captured segment into its window")
+PUBLISH_TIME = metrics.registry.histogram('identifier_publish_seconds',
+    "Time spent handing an event to the output")
+PACKETS = metrics.registry.counter('identifier_packets_total',
+    "Captured packets")
+SEGMENTS = metrics.registry.counter('identifier_segments_total',
+    "Captured segments within the allowed segment sizes")
 
-    identification_db = db.IdentificationDB(window_width, k)
+def get_publisher(embedded):
+    """Returns the function used to hand events to the web interface. In
+    embedded mode the web server runs in this process and events go straight
+    to its broadcaster, otherwise they are posted to a separate server from
+    a background thread, batching the events that arrive during a post.
+    The metrics of the identifier are pushed to the separate server along
+    with the events, every METRICS_PUSH_INTERVAL seconds.
+    """
+    if embedded:
+        import sse_server
+        server = sse_server.SSEServer()
+        server.start_in_background()
+        return server.broadcast_sse
 
-    with console.status("Identifier running (CTRL-C to quit)...",
-            spinner='circle'):
+    import requests
+    events = queue.SimpleQueue()
 
-        streams = {}
-        capture_filter = ('src ' + ' or src '.join(network.get_svtplay_ips(
-            full_cdn_search)) + ' and greater 0')
-        packet_analyzer = network.get_packet_analyzer(capture_filter,
-            interface)
+    def post_batches():
+        last_push = None
+        while True:
+            try:
+                batch = [events.get(timeout=METRICS_PUSH_INTERVAL)]
+            except queue.Empty:
+                batch = []
+            while not events.empty():
+                batch.append(events.get())
+            try:
+                if batch:
+                    requests.post(WEB_SERVER_URL + '/batch', json=batch)
+                if (last_push is None or
+                        monotonic() - last_push >= METRICS_PUSH_INTERVAL):
+                    last_push = monotonic()
+                    requests.post(WEB_SERVER_URL + '/metrics',
+                        data=metrics.registry.render().encode(),
+                        headers={'Content-Type': 'text/plain'})
+            except requests.exceptions.RequestException as e:
+                console.log(f"[red]Could not reach the web interface:[/red] "
+                            f"{e}")
+
+    Thread(target=post_batches, daemon=True).start()
+    return events.put
+
+def get_file_publisher(file_path):
+    """Returns a function writing events as JSON lines to a file, e.g. to
+    compare the identification of replayed traffic with its ground truth.
+    """
+    # Line buffered, every event is on disk once it is published
+    output_file = open(file_path, 'w', encoding='utf8', buffering=1)
+
+    def write(data):
+        output_file.write(json.dumps(data) + '\n')
+
+    return write
+
+class LiveCapture:
+    """Packet capture on the SVT Play CDN addresses. Updating the addresses
+    restarts the capture with a new filter, packet times continue from the
+    previous capture.
+    """
+    def __init__(self, interface, svtplay_ips=()):
+        self._interface = interface
+        self._svtplay_ips = set(svtplay_ips)
+        self._packet_analyzer = None
+        self._restart = Event()
+        self._stopped = Event()
+        self._lock = Lock()
+
+    def update(self, svtplay_ips):
+        """Restart the capture if the addresses have changed, safe to call
+        from any thread. No addresses at all leave the capture as it is.
+        """
+        with self._lock:
+            if not svtplay_ips or set(svtplay_ips) == self._svtplay_ips:
+                return
+            self._svtplay_ips = set(svtplay_ips)
+            self._restart.set()
+            if self._packet_analyzer is not None:
+                self._packet_analyzer.terminate()
+
+    def stop(self):
+        """End the capture, safe to call from any thread."""
+        with self._lock:
+            self._stopped.set()
+            if self._packet_analyzer is not None:
+                self._packet_analyzer.terminate()
+
+    def packets(self):
+        """Yields (src, dst, time, size) for every captured packet."""
+        capture_start = None
+        while True:
+            with self._lock:
+                if self._stopped.is_set():
+                    return
+                self._restart.clear()
+                capture_filter = network.get_capture_filter(
+                    self._svtplay_ips)
+                self._packet_analyzer = network.get_packet_analyzer(
+                    capture_filter, self._interface)
+            # Packet times are relative to the first packet of a capture
+            time_offset = None
+            try:
+                for packet in iter(self._packet_analyzer.stdout.readline,
+                                   ''):
+                    start = perf_counter()
+                    src, dst, time, size = network.format_packet(packet)
+                    PARSE_TIME.observe(perf_counter() - start)
+                    PACKETS.inc()
+                    if time_offset is None:
+                        now = monotonic()
+                        if capture_start is None:
+                            capture_start = now
+                        time_offset = now - capture_start - time
+                    yield src, dst, time + time_offset, size
+            finally:
+                self._packet_analyzer.kill()
+
+            if not self._restart.is_set() or self._stopped.is_set():
+                return
+            console.log("CDN addresses changed, restarting capture")
+
+class FileCapture:
+    """Packets read from tcpdump text output or a pcap file, replayed as
+    fast as they can be processed.
+    """
+    def __init__(self, file_path):
+        self._file_path = file_path
+        self._stopped = Event()
+
+    def update(self, svtplay_ips):
+        # Recorded packets are replayed unfiltered
+        pass
+
+    def stop(self):
+        """End the replay, safe to call from any thread."""
+        self._stopped.set()
+
+    def packets(self):
+        """Yields (src, dst, time, size) for every packet of the file."""
+        if self._file_path.endswith('.pcap'):
+            reader = network.get_packet_reader(self._file_path)
+            lines = reader.stdout
+        else:
+            reader = None
+            lines = open(self._file_path, encoding='utf8')
         try:
-            for packet in iter(packet_analyzer.stdout.readline, ''):
+            for packet in lines:
+                if self._stopped.is_set():
+                    return
+                start = perf_counter()
                 src, dst, time, size = network.format_packet(packet)
+                PARSE_TIME.observe(perf_counter() - start)
+                PACKETS.inc()
+                yield src, dst, time, size
+        finally:
+            lines.close()
+            if reader is not None:
+                reader.kill()
+
+class Stream:
+    """Segmenting and identification state of a captured stream."""
+    def __init__(self, number, init_time, init_segment, window_width,
+                 voting=None):
+        self.number = number
+        self.init_time = init_time
+        self.last_active = init_time
+        self.segment = init_segment
+        self.window = deque(maxlen=window_width)
+        self.identified = False
+        # (video id, fingerprint index, window index) of the latest matches
+        self.tracked = []
+        # Positions of the candidates for the first, not yet full, window
+        self.early = []
+        self.voting = voting
+
+def identify(identification_db, flow, window, pearson_threshold):
+    """Verifies the window of an identified stream against the positions
+    following its latest matches, only searching the whole database when
+    none of them match any longer.
+    """
+    located = []
+    if flow.tracked:
+        located = identification_db.verify(window,
+            [(video_id, fingerprint_index, window_index + 1)
+             for video_id, fingerprint_index, window_index in flow.tracked],
+            pearson_threshold)
+    elif flow.early:
+        # The first full window starts where the prefix candidates start
+        located = identification_db.verify(window, flow.early,
+                                           pearson_threshold)
+        flow.early = []
+    if not located and flow.voting is not None:
+        located = identification_db.vote(window, flow.voting,
+                                         pearson_threshold)
+    elif not located:
+        located = identification_db.locate(window, pearson_threshold)
+    elif flow.voting is not None:
+        # Votes from before tracking still expect this window
+        flow.voting.skip()
+    flow.tracked = [position for _, position in located]
+    return [match for match, _ in located]
+
+def identify_prefix(identification_db, flow, window, pearson_threshold):
+    """Identifies a stream with fewer segments than the window width. The
+    candidates of a prefix are verified again as every segment arrives, and
+    are matched once they have passed the threshold for two prefixes in a
+    row with no other video remaining.
+    """
+    confirmed = []
+    if flow.early:
+        confirmed = identification_db.verify(window, flow.early,
+                                             pearson_threshold)
+    if confirmed:
+        flow.early = [position for _, position in confirmed]
+        if len({match['id'] for match, _ in confirmed}) == 1:
+            return [match for match, _ in confirmed]
+        return []
+
+    flow.early = []
+    if len(window) in identification_db.prefix_widths:
+        flow.early = [position for _, position in
+                      identification_db.locate(window, pearson_threshold)]
+    return []
+
+def load_in_background(load):
+    """Runs load in a daemon thread and returns a future of its result, so
+    that capturing can start while the index is built.
+    """
+    future = Future()
+
+    def run_load():
+        try:
+            future.set_result(load())
+        except Exception as e:
+            future.set_exception(e)
+
+    Thread(target=run_load, daemon=True).start()
+    return future
+
+def run(interface, cli, window_width, k, pearson_threshold, full_cdn_search,
+        embedded=False, metrics_interval=METRICS_INTERVAL,
+        vote_confidence=None, vote_min_r=db.VOTE_MIN_R, prefix_widths=(),
+        cache_size=db.CACHE_SIZE, share_index=None, attach_index=None,
+        daemon_socket=None, read_file=None, leaf_size=db.LEAF_SIZE,
+        neighbor_amount=db.NEIGHBOR_AMOUNT, output_file=None,
+        cache_quantum=db.CACHE_QUANTUM):
+
+    shared_index = None
+    index = None
+    if daemon_socket:
+        # The window width and prefixes are those of the daemon's index
+        import daemon
+        identification_db = daemon.IdentificationClient(daemon_socket)
+        window_width = identification_db.window_width
+        prefix_widths = identification_db.prefix_widths
+    elif attach_index:
+        # The window width and prefixes are those of the shared index
+        identification_db = db.IdentificationDB.attach(attach_index,
+            cache_size=cache_size, cache_quantum=cache_quantum,
+            neighbor_amount=neighbor_amount)
+        window_width = identification_db.window_width
+        prefix_widths = identification_db.prefix_widths
+    else:
+        # Capture while the index is built, completed windows wait for it.
+        # The build logs its progress, the status line is the capture's
+        identification_db = None
+
+        def build_index():
+            built_db = db.IdentificationDB(window_width, k,
+                prefix_widths=prefix_widths, cache_size=cache_size,
+                cache_quantum=cache_quantum, leaf_size=leaf_size,
+                neighbor_amount=neighbor_amount, quiet=True)
+            return built_db, (built_db.share(share_index) if share_index
+                              else None)
+
+        index = load_in_background(build_index)
+    if cli:
+        publish = None
+    elif output_file:
+        publish = get_file_publisher(output_file)
+    else:
+        publish = get_publisher(embedded)
+
+    def publish_event(flow, data):
+        # Profiles attribute the time spent below this frame to publishing
+        with PUBLISH_TIME.time():
+            if cli:
+                format.cli_print(data, flow.number)
+            elif not flow.identified:
+                if data['Match']:
+                    flow.identified = True
+                publish(data)
+
+    def identify_and_publish(flow, window, data):
+        if len(window) == window_width:
+            data['Match'] = identify(identification_db, flow, window,
+                                     pearson_threshold)
+        elif prefix_widths and len(window) >= min(prefix_widths):
+            data['Match'] = identify_prefix(identification_db, flow, window,
+                                            pearson_threshold)
+        publish_event(flow, data)
+
+    running = "Identifier running (CTRL-C to quit)..."
+    with console.status(running if identification_db is not None else
+            "Capturing while the index is loading (CTRL-C to quit)...",
+            spinner='circle') as status:
+
+        streams = {}
+        # (stream, window, event) of completed windows awaiting the index
+        pending = deque()
+        if read_file:
+            capture = FileCapture(read_file)
+        else:
+            capture = LiveCapture(interface)
+            if not network.get_svtplay_ips(full_cdn_search,
+                                           on_update=capture.update):
+                raise RuntimeError("none of the SVT Play CDN hostnames " +
+                    "resolved, check the network connection!")
+        if index is not None:
+            # A failed build ends the capture instead of waiting for a packet
+            def stop_on_error(index):
+                if index.exception() is not None:
+                    capture.stop()
+
+            index.add_done_callback(stop_on_error)
+        packets = capture.packets()
+        last_summary = monotonic()
+        try:
+            for src, dst, time, size in packets:
+                assembly_start = perf_counter()
                 stream = (src, dst)
 
+                if identification_db is None and index.done():
+                    identification_db, shared_index = index.result()
+                    status.update(running)
+                    while pending:
+                        identify_and_publish(*pending.popleft())
+
+                if (cli and metrics_interval
+                        and monotonic() - last_summary > metrics_interval):
+                    console.print(metrics.registry.summary())
+                    last_summary = monotonic()
+
                 if stream not in streams:
-                    init_time = last_active = time
-                    init_segment = size
-                    window = deque(maxlen=window_width)
-                    identified = False
-                    streams[stream] = [init_time, last_active,
-                        init_segment, window, identified]
+                    voting = (db.EvidenceVoting(vote_confidence, vote_min_r)
+                              if vote_confidence else None)
+                    streams[stream] = Stream(len(streams) + 1, time, size,
+                                             window_width, voting)
                     continue
 
-                init_time, last_active, segment, window, \
-                    identified = streams[stream]
+                flow = streams[stream]
 
                 # Real-time segmenting and matching
-                if time - last_active > SEGMENT_TIME_THRESHOLD:
+                if time - flow.last_active > SEGMENT_TIME_THRESHOLD:
 
-                    captured_segment = (round(segment / TLS_OVERHEAD)
+                    captured_segment = (round(flow.segment / TLS_OVERHEAD)
                                         - HTTP_HEADERS)
 
                     if MIN_SEGMENT_SIZE < captured_segment < MAX_SEGMENT_SIZE:
 
-                        window.append(captured_segment)
-                        time_elapsed = round(last_active-init_time, 1)
+                        flow.window.append(captured_segment)
+                        time_elapsed = round(flow.last_active-flow.init_time,
+                                             1)
                         data = {'IP src': src, 'IP dst': dst,
                             'Elapsed': time_elapsed,
                             'Captured segment': captured_segment,
                             'Match': []}
+                        SEGMENTS.inc()
+                        SEGMENT_TIME.observe(perf_counter() - assembly_start)
 
-                        if len(window) == window_width:
-                            match_or_empty = identification_db.identify(
-                                window, pearson_threshold)
-                            data['Match'] = match_or_empty
-
-                        if cli:
-                            format.cli_print(data,
-                                list(streams.keys()).index(stream)+1)
-                        elif not identified:
-                            if data['Match']:
-                                streams[stream][4] = True
-                            requests.post('http://localhost:5000', json=data)
+                        if identification_db is None:
+                            pending.append((flow, tuple(flow.window), data))
+                        else:
+                            identify_and_publish(flow, flow.window, data)
 
                     # Start building new segment
-                    streams[stream][2] = 0
+                    flow.segment = 0
+
+                flow.last_active = time
+                flow.segment += size
 
-                streams[stream][1] = time
-                streams[stream][2] += size
+            # The capture ended before the index was ready
+            if identification_db is None:
+                identification_db, shared_index = index.result()
+                while pending:
+                    identify_and_publish(*pending.popleft())
 
         except KeyboardInterrupt:
             print("Quitting identifier...")
         finally:
-            packet_analyzer.kill()
+            packets.close()
+            if daemon_socket:
+                identification_db.close()
+            if (shared_index is None and index is not None and
+                    index.done() and index.exception() is None):
+                # The index was shared after the last captured packet
+                _, shared_index = index.result()
+            if shared_index is not None:
+                shared_index.close()
+                shared_index.unlink()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Detects and identifies HTTPS " +
             "encrypted videos from SVT Play.")
     parser.add_argument("-i", "--interface",
-        help="network interface to run identifier on",
-        required=True)
+        help="network interface to run identifier on, required unless " +
+            "--read-file is given")
+    parser.add_argument("--read-file",
+        help="identify the packets of tcpdump text output or a pcap file " +
+            "instead of capturing")
     parser.add_argument('--full-cdn-search',
         action=argparse.BooleanOptionalAction,
         help="")
     parser.add_argument('--cli',
         action=argparse.BooleanOptionalAction,
         help="show output in the terminal instead of web interface")
+    parser.add_argument('--embedded',
+        action=argparse.BooleanOptionalAction,
+        help="serve the web interface from the identifier process")
     parser.add_argument('-w', "--window-width",
         help="amount of segments in a window",
         type=int,
@@ -104,11 +461,109 @@ if __name__ == "__main__":
         help="pearson's r threshold used when determining a match",
         type=float,
         default=0.99999999)
+    parser.add_argument("--leaf-size",
+        help="leaf size of the k-d tree",
+        type=int,
+        default=db.LEAF_SIZE)
+    parser.add_argument("--neighbor-amount",
+        help="amount of nearest neighbors verified with pearson's r",
+        type=int,
+        default=db.NEIGHBOR_AMOUNT)
+    parser.add_argument("--config",
+        help="JSON file of option defaults, e.g. the configuration " +
+            "chosen by tests/tuner.py, options given here take precedence")
+    parser.add_argument("--prefix-widths",
+        help="build additional k-d trees for these amounts of segments, " +
+            "to identify streams before a full window is captured",
+        type=int,
+        nargs='+',
+        default=())
+    parser.add_argument("--cache-size",
+        help="amount of identification results cached for windows seen " +
+            "in other streams, 0 to disable",
+        type=int,
+        default=db.CACHE_SIZE)
+    parser.add_argument("--cache-quantum",
+        help="bytes the segment sizes of a window are rounded to for the " +
+            "cache, windows differing by less share results, 1 only " +
+            "serves exact repeats",
+        type=int,
+        default=db.CACHE_QUANTUM)
+    parser.add_argument("--share-index",
+        help="publish the index in shared memory under this name for " +
+            "identifiers on other interfaces")
+    parser.add_argument("--attach-index",
+        help="use the index another identifier published under this " +
+            "name instead of building one")
+    parser.add_argument("--daemon-socket",
+        help="query the identification daemon listening on this socket " +
+            "instead of building an index")
+    parser.add_argument("--vote-confidence",
+        help="let consecutive windows vote and match once their combined " +
+            "pearson's r passes this confidence",
+        type=float)
+    parser.add_argument("--vote-min-r",
+        help="minimum pearson's r of a window to vote",
+        type=float,
+        default=db.VOTE_MIN_R)
+    parser.add_argument("--metrics-interval",
+        help="seconds between metrics summaries in the terminal, 0 to " +
+            "disable",
+        type=int,
+        default=METRICS_INTERVAL)
+    parser.add_argument("--output-file",
+        help="write the events as JSON lines to this file instead of " +
+            "the web interface, e.g. for tests/traffic_checker.py")
+    parser.add_argument('--profile',
+        help="profile the identifier, deterministically or by sampling " +
+            "the stack",
+        choices=profiling.MODES)
+    parser.add_argument('--profile-output',
+        help="path prefix of the written .pstats or .collapsed file",
+        default='identifier_profile')
+    parser.add_argument('--profile-duration',
+        help="stop the identifier after this many seconds",
+        type=float)
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument("--config")
+    config_args, _ = config_parser.parse_known_args()
+    if config_args.config:
+        with open(config_args.config, encoding='utf8') as config_file:
+            parser.set_defaults(**json.load(config_file))
     args = parser.parse_args()
+    if not args.interface and not args.read_file:
+        parser.error("the following arguments are required: -i/--interface")
+    if args.daemon_socket and args.vote_confidence:
+        parser.error("--vote-confidence is not supported with --daemon-socket")
+    if args.cli and args.output_file:
+        parser.error("--output-file is not supported with --cli")
+    if args.cache_quantum < 1:
+        parser.error("--cache-quantum has to be at least 1")
     interface = args.interface
     full_cdn_search = args.full_cdn_search
     cli = args.cli
+    embedded = args.embedded
     window_width = args.window_width
     k = args.k_dimension
     pearson_threshold = args.pearson_threshold
-    run(interface, cli, window_width, k, pearson_threshold, full_cdn_search)
+    metrics_interval = args.metrics_interval
+    vote_confidence = args.vote_confidence
+    vote_min_r = args.vote_min_r
+    prefix_widths = args.prefix_widths
+    cache_size = args.cache_size
+    share_index = args.share_index
+    attach_index = args.attach_index
+    daemon_socket = args.daemon_socket
+    read_file = args.read_file
+    leaf_size = args.leaf_size
+    neighbor_amount = args.neighbor_amount
+    profiler = (profiling.Profiler(args.profile, args.profile_output)
+                if args.profile else nullcontext())
+    if args.profile_duration:
+        profiling.stop_after(args.profile_duration)
+    with profiler:
+        run(interface, cli, window_width, k, pearson_threshold,
+            full_cdn_search, embedded, metrics_interval, vote_confidence,
+            vote_min_r, prefix_widths, cache_size, share_index,
+            attach_index, daemon_socket, read_file, leaf_size,
+            neighbor_amount, args.output_file, args.cache_quantum)
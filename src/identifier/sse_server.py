@@ -0,0 +1,299 @@
+"""Event loop based server for the web interface. Every subscriber is an
+idle stream on a single thread, so thousands of dashboards can be
+connected at once. Slow subscribers lose messages according to their
+subscription policy instead of holding up the others, and new
+subscribers are sent the recent history first. Serves the same
+routes as app.py and can replace `flask run`, or be started in the
+background by the identifier.
+"""
+
+from collections import deque
+from timeit import default_timer as timer
+from os import path
+import argparse
+import asyncio
+import json
+import mimetypes
+import threading
+import urllib.parse
+import jinja2
+import subscriptions
+from utils import format, metrics
+from utils.console import console
+
+HERE = path.dirname(path.abspath(__file__))
+STATIC_DIR = path.join(HERE, 'static')
+TEMPLATE_DIR = path.join(HERE, 'templates')
+
+MAX_REQUEST_SIZE = 1024 * 1024
+FANOUT_HISTORY = 1000
+
+FANOUT_TIME = metrics.registry.histogram('web_fanout_seconds',
+    "Time spent handing a broadcast to all subscribers")
+BROADCASTS = metrics.registry.counter('web_broadcasts_total',
+    "Broadcast messages")
+
+SSE_HEADERS = (b'HTTP/1.1 200 OK\r\n'
+               b'Content-Type: text/event-stream\r\n'
+               b'Cache-Control: no-cache\r\n'
+               b'Access-Control-Allow-Origin: *\r\n'
+               b'\r\n')
+
+class _Client:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.ready = asyncio.Event()
+
+class SSEServer:
+    """Broadcasts server-sent events to all subscribing clients. Each
+    message is encoded once and the same bytes are written to every client.
+    """
+    def __init__(self, host='127.0.0.1', port=5000):
+        self._host = host
+        self._port = port
+        self._clients = set()
+        self._history = subscriptions.History()
+        self._loop = None
+        self._index = None
+        # Latest metrics pushed by a separate identifier process
+        self._identifier_metrics = b''
+        self.broadcasts = 0
+        # (subscriber count, seconds) for the latest broadcasts
+        self.fanout_latencies = deque(maxlen=FANOUT_HISTORY)
+
+    def run(self):
+        """Serve until interrupted, blocking the calling thread."""
+        asyncio.run(self._serve())
+
+    def start_in_background(self):
+        """Serve from a daemon thread and return once the server listens.
+        Raises the error of the server if it could not start listening.
+        """
+        listening = threading.Event()
+        errors = []
+
+        def serve():
+            try:
+                asyncio.run(self._serve(listening))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                listening.set()
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        listening.wait()
+        if errors:
+            raise errors[0]
+        return thread
+
+    def broadcast_sse(self, msg):
+        """Broadcast a message to all subscribing clients, safe to call
+        from any thread.
+        """
+        self._loop.call_soon_threadsafe(self._fan_out, msg)
+
+    def broadcast_many(self, msgs):
+        """Broadcast several messages in order, safe to call from any
+        thread.
+        """
+        self._loop.call_soon_threadsafe(self._fan_out_many, msgs)
+
+    def stats(self):
+        latencies = [latency for _, latency in self.fanout_latencies]
+        return {
+            'Subscribers': len(self._clients),
+            'Broadcasts': self.broadcasts,
+            'Dropped messages': sum(client.buffer.dropped
+                                    for client in self._clients),
+            'Last fan-out latency': latencies[-1] if latencies else None,
+            'Average fan-out latency': (sum(latencies) / len(latencies)
+                                        if latencies else None),
+            'Max fan-out latency': max(latencies) if latencies else None}
+
+    async def _serve(self, listening=None):
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._handle, self._host,
+            self._port, limit=MAX_REQUEST_SIZE)
+        console.log(f"Web interface running on "
+                    f"http://{self._host}:{self._port}")
+        if listening is not None:
+            listening.set()
+        async with server:
+            await server.serve_forever()
+
+    def _fan_out(self, msg):
+        self._fan_out_many((msg,))
+
+    def _fan_out_many(self, msgs):
+        for msg in msgs:
+            start = timer()
+            sse_msg = format.format_sse(data=json.dumps(msg)).encode()
+            flow = subscriptions.flow_of(msg)
+            self._history.add(flow, sse_msg)
+
+            for client in self._clients:
+                client.buffer.put(flow, sse_msg)
+                client.ready.set()
+
+            latency = timer() - start
+            self.broadcasts += 1
+            self.fanout_latencies.append((len(self._clients), latency))
+            FANOUT_TIME.observe(latency)
+            BROADCASTS.inc()
+
+    async def _handle(self, reader, writer):
+        try:
+            method, route, query, body = await _read_request(reader)
+        except (ValueError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        if method == 'GET' and route == '/subscribe':
+            try:
+                buffer = subscriptions.create_buffer(
+                    query.get('policy', [None])[0])
+            except ValueError as e:
+                writer.write(_response(str(e).encode(), 'text/plain',
+                                       '400 Bad Request'))
+                writer.close()
+                return
+            await self._subscribe(reader, writer, buffer)
+            return
+
+        if method == 'POST' and route in ('/', '/batch'):
+            response = self._post(route, body)
+        elif method == 'GET' and route == '/':
+            response = _response(self._render_index(), 'text/html')
+        elif method == 'POST' and route == '/metrics':
+            self._identifier_metrics = body
+            response = _response(b'{"Status": "OK"}', 'application/json')
+        elif method == 'GET' and route == '/metrics':
+            response = _response(metrics.registry.render().encode() +
+                                 self._identifier_metrics,
+                                 'text/plain; version=0.0.4')
+        elif method == 'GET' and route == '/stats':
+            response = _response(json.dumps(self.stats()).encode(),
+                                 'application/json')
+        elif method == 'GET' and route.startswith('/static/'):
+            response = _static_response(route[len('/static/'):])
+        else:
+            response = _response(b'Not Found', 'text/plain', '404 Not Found')
+
+        writer.write(response)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def _post(self, route, body):
+        try:
+            msgs = json.loads(body)
+        except ValueError:
+            return _response(b'{"Status": "Invalid JSON"}',
+                             'application/json', '400 Bad Request')
+        if route == '/':
+            if not isinstance(msgs, dict):
+                return _response(b'{"Status": "Expected a message object"}',
+                                 'application/json', '400 Bad Request')
+            self._fan_out(msgs)
+            return _response(b'{"Status": "OK"}', 'application/json')
+        # Checked before any message is sent, a batch is sent whole or not
+        if not (isinstance(msgs, list) and
+                all(isinstance(msg, dict) for msg in msgs)):
+            return _response(
+                b'{"Status": "Expected an array of message objects"}',
+                'application/json', '400 Bad Request')
+        self._fan_out_many(msgs)
+        return _response(json.dumps({"Status": "OK",
+            "Received": len(msgs)}).encode(), 'application/json')
+
+    async def _subscribe(self, reader, writer, buffer):
+        """Keep the connection open until the client goes away."""
+        # The history goes straight to the connection, past the buffer's
+        # policy, before any broadcast can reach the client
+        writer.write(SSE_HEADERS + b''.join(
+            sse_msg for _, sse_msg in self._history.replay()))
+        client = _Client(buffer)
+        self._clients.add(client)
+        sender = asyncio.create_task(_send(client, writer))
+        try:
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self._clients.discard(client)
+            sender.cancel()
+            writer.close()
+
+    def _render_index(self):
+        if self._index is None:
+            env = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(TEMPLATE_DIR))
+            template = env.get_template('index.html')
+            self._index = template.render(
+                url_for=lambda _, filename: '/static/' + filename).encode()
+        return self._index
+
+async def _send(client, writer):
+    """Write buffered messages to a client as fast as it consumes them."""
+    try:
+        while True:
+            await client.ready.wait()
+            client.ready.clear()
+            while client.buffer:
+                writer.write(client.buffer.pop())
+            await writer.drain()
+    except ConnectionError:
+        pass
+
+async def _read_request(reader):
+    """Returns the method, route, query and body of an HTTP request."""
+    head = await reader.readuntil(b'\r\n\r\n')
+    request_line, *header_lines = head.decode('latin-1').split('\r\n')
+    method, target, _ = request_line.split(' ', 2)
+    content_length = 0
+    for line in header_lines:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            content_length = int(value)
+    if content_length > MAX_REQUEST_SIZE:
+        raise ValueError("request body too large")
+    body = await reader.readexactly(content_length)
+    route, _, query = target.partition('?')
+    return method, route, urllib.parse.parse_qs(query), body
+
+def _response(body, content_type, status='200 OK'):
+    head = (f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n')
+    return head.encode() + body
+
+def _static_response(filename):
+    file_path = path.normpath(path.join(STATIC_DIR, filename))
+    if (not file_path.startswith(STATIC_DIR + path.sep)
+            or not path.isfile(file_path)):
+        return _response(b'Not Found', 'text/plain', '404 Not Found')
+    content_type = mimetypes.guess_type(file_path)[0] or \
+        'application/octet-stream'
+    with open(file_path, 'rb') as file:
+        return _response(file.read(), content_type)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serves the web interface and broadcasts identifier " +
+            "events to subscribing clients.")
+    parser.add_argument('--host',
+        default='127.0.0.1')
+    parser.add_argument('--port',
+        type=int,
+        default=5000)
+    args = parser.parse_args()
+    try:
+        SSEServer(args.host, args.port).run()
+    except KeyboardInterrupt:
+        print("Quitting server...")
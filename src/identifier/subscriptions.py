@@ -0,0 +1,102 @@
+"""Per-subscriber message buffers for the web interface. Broadcasting never
+blocks and never disconnects a client, a client that falls behind loses
+messages according to its buffer's policy instead. Recent messages are
+kept in a history which is replayed to new subscribers.
+"""
+
+from collections import deque, OrderedDict
+
+DEFAULT_POLICY = 'drop-oldest'
+BUFFER_SIZE = 64
+MAX_FLOWS = 1024
+HISTORY_SIZE = 32
+
+class DropOldest:
+    """Ring buffer keeping the latest messages, the oldest message is
+    dropped when a new message arrives to a full buffer.
+    """
+    def __init__(self, size=BUFFER_SIZE):
+        self._messages = deque(maxlen=size)
+        self.dropped = 0
+
+    def put(self, flow, msg):
+        if len(self._messages) == self._messages.maxlen:
+            self.dropped += 1
+        self._messages.append(msg)
+
+    def pop(self):
+        return self._messages.popleft()
+
+    def __len__(self):
+        return len(self._messages)
+
+class Coalescing:
+    """Keeps only the latest pending message per flow. A new message for a
+    flow replaces its pending message, flows are sent in the order they
+    first became pending.
+    """
+    def __init__(self, max_flows=MAX_FLOWS):
+        self._pending = OrderedDict()
+        self._max_flows = max_flows
+        self.dropped = 0
+
+    def put(self, flow, msg):
+        if flow in self._pending:
+            self.dropped += 1
+        elif len(self._pending) == self._max_flows:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+        self._pending[flow] = msg
+
+    def pop(self):
+        if not self._pending:
+            raise IndexError("pop from an empty buffer")
+        _, msg = self._pending.popitem(last=False)
+        return msg
+
+    def __len__(self):
+        return len(self._pending)
+
+class History:
+    """Keeps the latest message per flow and the last messages overall, so
+    that a late subscriber can be brought up to date.
+    """
+    def __init__(self, size=HISTORY_SIZE, max_flows=MAX_FLOWS):
+        self._latest = OrderedDict()
+        self._recent = deque(maxlen=size)
+        self._max_flows = max_flows
+        self._seq = 0
+
+    def add(self, flow, msg):
+        self._seq += 1
+        self._latest.pop(flow, None)
+        if len(self._latest) == self._max_flows:
+            self._latest.popitem(last=False)
+        self._latest[flow] = (self._seq, msg)
+        self._recent.append((self._seq, flow, msg))
+
+    def replay(self):
+        """Returns (flow, message) pairs in the order they were added, the
+        latest message of every flow followed by the last messages.
+        """
+        first_recent = self._recent[0][0] if self._recent else self._seq + 1
+        return ([(flow, msg) for flow, (seq, msg) in self._latest.items()
+                 if seq < first_recent] +
+                [(flow, msg) for _, flow, msg in self._recent])
+
+POLICIES = {
+    'drop-oldest': DropOldest,
+    'coalesce': Coalescing
+}
+
+def create_buffer(policy=None):
+    """Returns an empty message buffer for the given policy."""
+    policy = policy or DEFAULT_POLICY
+    if policy not in POLICIES:
+        raise ValueError(f"unknown subscription policy '{policy}', " +
+            f"choose from {', '.join(POLICIES)}")
+    return POLICIES[policy]()
+
+def flow_of(msg):
+    """Returns the flow a message belongs to."""
+    return msg.get('IP src'), msg.get('IP dst')
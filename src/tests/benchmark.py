@@ -0,0 +1,203 @@
+"""Benchmarks IdentificationDB on synthetic catalogs of growing size. Every
+configuration runs in a fresh process, measuring the build time, the
+identify latency percentiles, the throughput of identify_many on all
+windows at once and the peak RSS. Results are written as JSON for
+comparisons between versions.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from identifier import db
+from utils.console import console
+from timeit import default_timer as timer
+from os import path
+import multiprocessing
+import argparse
+import datetime
+import json
+import platform
+import resource
+import subprocess
+import sys
+import numpy as np
+import synthetic
+
+def benchmark(videos, window_width, k_dimension, queries, pearson_threshold,
+              seed=0, catalog_shape=None):
+    """Benchmarks one configuration, returns its results. catalog_shape
+    holds keyword arguments of synthetic.generate_catalog, e.g. the
+    durations, complexity sigma and amount of qualities of the videos.
+    """
+    catalog = synthetic.generate_catalog(videos, seed=seed,
+                                         **(catalog_shape or {}))
+    windows = synthetic.sample_windows(catalog, window_width, queries,
+                                       seed=seed)
+    rss_before_build = _peak_rss()
+
+    start = timer()
+    # Without the cache every query searches the tree
+    identification_db = db.IdentificationDB(window_width, k_dimension,
+                                            catalog, cache_size=0)
+    build_time = timer() - start
+
+    latencies = []
+    identified = 0
+    for video_id, window in windows:
+        start = timer()
+        matches = identification_db.identify(window, pearson_threshold)
+        latencies.append(timer() - start)
+        if any(match['id'] == video_id for match in matches):
+            identified += 1
+
+    # One k-d tree query for all windows instead of one per window
+    start = timer()
+    identification_db.identify_many([window for _, window in windows],
+                                    pearson_threshold)
+    batch_time = timer() - start
+
+    return {
+        "Videos": videos,
+        "Segments": sum(len(fingerprint) for video in catalog.values()
+                        for fingerprint in video['fingerprints']),
+        "Window width": window_width,
+        "K-dimension": k_dimension,
+        "Queries": queries,
+        "Build time": build_time,
+        "p50 latency": float(np.percentile(latencies, 50)),
+        "p99 latency": float(np.percentile(latencies, 99)),
+        "Batch throughput": queries / batch_time,
+        "Identified": identified / queries,
+        "Peak RSS before build": rss_before_build,
+        "Peak RSS": _peak_rss()}
+
+def run_benchmarks(video_amounts, window_widths, kd_dimensions, queries,
+                   pearson_threshold, seed=0, catalog_shape=None):
+    results = []
+    for videos in video_amounts:
+        for window_width in window_widths:
+            for kd_dimension in kd_dimensions:
+                print(f"Benchmarking {videos} videos with window width " +
+                    f"{window_width} and k-dimension {kd_dimension}...")
+                # A fresh process per configuration keeps the peak RSS of
+                # earlier configurations out of its measurement
+                with ProcessPoolExecutor(max_workers=1,
+                        mp_context=multiprocessing.get_context('spawn')) \
+                        as executor:
+                    try:
+                        results.append(executor.submit(benchmark, videos,
+                            window_width, kd_dimension, queries,
+                            pearson_threshold, seed,
+                            catalog_shape).result())
+                    except ValueError as e:
+                        print("Error:", e, "Continuing...")
+    return results
+
+def environment():
+    """Returns what the results depend on besides the configuration."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=path.dirname(path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import sklearn
+    return {
+        "Commit": commit,
+        "Date": datetime.datetime.now().isoformat(timespec='seconds'),
+        "Python": platform.python_version(),
+        "NumPy": np.__version__,
+        "scikit-learn": sklearn.__version__,
+        "Machine": platform.machine(),
+        "CPUs": multiprocessing.cpu_count()}
+
+def print_results(results):
+    from rich.table import Table
+    table = Table(title="Benchmark")
+    for column in ("Videos", "w", "k", "Build", "p50", "p99", "Windows/s",
+                   "Identified", "Peak RSS"):
+        table.add_column(column, justify='right')
+    for result in results:
+        table.add_row(str(result["Videos"]), str(result["Window width"]),
+            str(result["K-dimension"]), f"{result['Build time']:.2f} s",
+            f"{result['p50 latency'] * 1000:.3f} ms",
+            f"{result['p99 latency'] * 1000:.3f} ms",
+            f"{result['Batch throughput']:.0f}",
+            f"{result['Identified'] * 100:.1f}%",
+            f"{result['Peak RSS'] / 2**20:.0f} MB")
+    console.print(table)
+
+def _peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the identification database on synthetic " +
+            "catalogs.")
+    parser.add_argument('-n', "--videos",
+        help="amounts of videos in the synthetic catalogs",
+        type=int,
+        nargs='+',
+        default=[100, 1000])
+    parser.add_argument('-w', "--window-widths",
+        type=int,
+        nargs='+',
+        default=[12])
+    parser.add_argument('-k', "--kd-dimensions",
+        type=int,
+        nargs='+',
+        default=[6])
+    parser.add_argument('-p', "--pearson-threshold",
+        type=float,
+        default=0.99)
+    parser.add_argument('-q', "--queries",
+        help="amount of windows identified per configuration",
+        type=int,
+        default=1000)
+    parser.add_argument("--min-duration",
+        help="shortest video in seconds",
+        type=int,
+        default=synthetic.MIN_DURATION)
+    parser.add_argument("--max-duration",
+        help="longest video in seconds",
+        type=int,
+        default=synthetic.MAX_DURATION)
+    parser.add_argument("--complexity-sigma",
+        help="sigma of the log-normal scene complexity, the spread of the " +
+            "segment sizes",
+        type=float,
+        default=synthetic.COMPLEXITY_SIGMA)
+    parser.add_argument("--complexity-correlation",
+        help="correlation of the complexity of consecutive segments",
+        type=float,
+        default=synthetic.COMPLEXITY_CORRELATION)
+    parser.add_argument("--qualities",
+        help="amount of quality levels, and fingerprints, per video",
+        type=int,
+        choices=range(1, len(synthetic.QUALITY_BITRATES) + 1),
+        default=len(synthetic.QUALITY_BITRATES))
+    parser.add_argument('--seed',
+        type=int,
+        default=0)
+    parser.add_argument('-o', "--output",
+        help="JSON file the results are written to",
+        default='benchmark_results.json')
+    args = parser.parse_args()
+    if not 0 < args.min_duration <= args.max_duration:
+        parser.error("--min-duration has to be positive and at most " +
+            "--max-duration")
+    catalog_shape = {
+        'min_duration': args.min_duration,
+        'max_duration': args.max_duration,
+        'complexity_sigma': args.complexity_sigma,
+        'complexity_correlation': args.complexity_correlation,
+        'qualities': args.qualities}
+    results = run_benchmarks(args.videos, args.window_widths,
+        args.kd_dimensions, args.queries, args.pearson_threshold, args.seed,
+        catalog_shape)
+    with open(args.output, 'w', encoding='utf8') as json_file:
+        json.dump({"Environment": environment(), "Catalog": catalog_shape,
+                   "Results": results}, json_file, indent=4)
+    print_results(results)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,161 @@
+"""Packed NumPy copies of the test data and the catalog. The CSV files are
+parsed once and converted to .npz files of flat arrays with per-video or
+per-fingerprint offsets, which are converted again whenever their CSV
+file is newer. Gathered test data is also appended to a binary file of
+video records next to the CSV file.
+"""
+
+from os import path
+import ast
+import csv
+import os
+import struct
+import numpy as np
+from identifier import db
+
+TEST_DATA_CSV = 'svtplay_test_data.csv'
+TEST_DATA_NPZ = 'svtplay_test_data.npz'
+TEST_DATA_BIN = 'svtplay_test_data.bin'
+CATALOG_NPZ = 'svtplay_db.npz'
+
+# Title length, id length, start time and segment amount of a video record
+RECORD_HEADER = struct.Struct('<HHII')
+
+def load_test_data(csv_path=TEST_DATA_CSV, npz_path=TEST_DATA_NPZ):
+    """Returns the test data as arrays: `sizes` and `times` of all captured
+    segments, `offsets` where the segments of each video start, and the
+    `titles`, `ids` and `start_times` of the videos.
+    """
+    if _outdated(npz_path, csv_path):
+        convert_test_data(csv_path, npz_path)
+    with np.load(npz_path) as npz:
+        return dict(npz)
+
+def convert_test_data(csv_path=TEST_DATA_CSV, npz_path=TEST_DATA_NPZ):
+    print("Converting test data file...")
+    sizes, times, offsets = [], [], [0]
+    titles, ids, start_times = [], [], []
+    with open(csv_path, encoding='utf8') as test_file:
+        for row in csv.reader(test_file):
+            titles.append(row[0])
+            ids.append(row[1])
+            start_times.append(row[2])
+            for segment_time in row[3:]:
+                captured_segment, time = ast.literal_eval(segment_time)
+                sizes.append(int(captured_segment))
+                times.append(float(time))
+            offsets.append(len(sizes))
+    _savez(npz_path,
+        sizes=np.array(sizes, dtype=np.int64),
+        times=np.array(times, dtype=np.float64),
+        offsets=np.array(offsets, dtype=np.int64),
+        titles=np.array(titles, dtype=str),
+        ids=np.array(ids, dtype=str),
+        start_times=np.array(start_times, dtype=str))
+
+def videos(test_data):
+    """Yields (title, id, start time, sizes, times) for every video."""
+    offsets = test_data['offsets']
+    for i in range(len(offsets) - 1):
+        start, end = offsets[i], offsets[i + 1]
+        yield (str(test_data['titles'][i]), str(test_data['ids'][i]),
+               str(test_data['start_times'][i]),
+               test_data['sizes'][start:end], test_data['times'][start:end])
+
+def append_test_data(title, svt_id, start_time, sizes, times,
+                     bin_path=TEST_DATA_BIN):
+    """Appends a video record to the binary test data file: the header,
+    the UTF-8 title and id, then the sizes as int64 and times as float64.
+    """
+    title, svt_id = title.encode('utf8'), svt_id.encode('utf8')
+    record = (RECORD_HEADER.pack(len(title), len(svt_id), int(start_time),
+                                 len(sizes)) +
+              title + svt_id +
+              np.asarray(sizes, dtype='<i8').tobytes() +
+              np.asarray(times, dtype='<f8').tobytes())
+    # A single write per record, an interrupted one only cuts the last
+    with open(bin_path, 'ab') as bin_file:
+        bin_file.write(record)
+
+def binary_videos(bin_path=TEST_DATA_BIN):
+    """Yields (title, id, start time, sizes, times) for every complete
+    video record of the binary test data file, like videos.
+    """
+    with open(bin_path, 'rb') as bin_file:
+        data = bin_file.read()
+    position = 0
+    while position + RECORD_HEADER.size <= len(data):
+        title_length, id_length, start_time, amount = \
+            RECORD_HEADER.unpack_from(data, position)
+        position += RECORD_HEADER.size
+        end = position + title_length + id_length + amount * 16
+        if end > len(data):
+            break
+        title = data[position:position + title_length].decode('utf8')
+        position += title_length
+        svt_id = data[position:position + id_length].decode('utf8')
+        position += id_length
+        sizes = np.frombuffer(data, '<i8', amount, position)
+        times = np.frombuffer(data, '<f8', amount, position + amount * 8)
+        position = end
+        yield title, svt_id, str(start_time), sizes, times
+
+def load_catalog(npz_path=CATALOG_NPZ):
+    """Returns the catalog as arrays: `segments` of all fingerprints,
+    `offsets` where each fingerprint starts, `fingerprint_videos` the index
+    of the video of each fingerprint, and the `ids`, `names`, `durations`
+    and `segment_lengths` of the videos.
+    """
+    if _outdated(npz_path, db.csv_db_path()):
+        print("Converting database file...")
+        pack_catalog(db.load_csv_db(), npz_path)
+    with np.load(npz_path) as npz:
+        return dict(npz)
+
+def pack_catalog(catalog, npz_path=CATALOG_NPZ):
+    segments, offsets, fingerprint_videos = [], [0], []
+    for video_number, video in enumerate(catalog.values()):
+        for fingerprint in video['fingerprints']:
+            segments.extend(fingerprint)
+            offsets.append(len(segments))
+            fingerprint_videos.append(video_number)
+    _savez(npz_path,
+        segments=np.array(segments, dtype=np.int64),
+        offsets=np.array(offsets, dtype=np.int64),
+        fingerprint_videos=np.array(fingerprint_videos, dtype=np.int64),
+        ids=np.array(list(catalog), dtype=str),
+        names=np.array([video['name'] for video in catalog.values()],
+                       dtype=str),
+        durations=np.array([video['duration']
+                            for video in catalog.values()], dtype=np.int64),
+        segment_lengths=np.array([video['segment_length']
+                                  for video in catalog.values()],
+                                 dtype=np.float64))
+
+def unpack_catalog(packed):
+    """Returns the catalog in the layout of db.load_csv_db."""
+    catalog = {}
+    segments = packed['segments']
+    offsets = packed['offsets']
+    for i, video_number in enumerate(packed['fingerprint_videos'].tolist()):
+        video_id = str(packed['ids'][video_number])
+        if video_id not in catalog:
+            catalog[video_id] = {
+                'name': str(packed['names'][video_number]),
+                'duration': int(packed['durations'][video_number]),
+                'segment_length': float(
+                    packed['segment_lengths'][video_number]),
+                'fingerprints': ()}
+        fingerprint = tuple(segments[offsets[i]:offsets[i + 1]].tolist())
+        catalog[video_id]['fingerprints'] += (fingerprint,)
+    return catalog
+
+def _outdated(npz_path, csv_path):
+    return (not path.exists(npz_path) or (path.exists(csv_path) and
+            path.getmtime(csv_path) > path.getmtime(npz_path)))
+
+def _savez(npz_path, **arrays):
+    # Ends in .npz, which np.savez would append otherwise
+    temporary_path = npz_path[:-len('.npz')] + '.tmp.npz'
+    np.savez(temporary_path, **arrays)
+    os.replace(temporary_path, npz_path)
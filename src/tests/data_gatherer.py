@@ -1,34 +1,266 @@
-"""Gathers test data by playing SVT Play videos in 
-svtplay_video_paths.txt and stores the segments as well 
-as the received times in svtplay_test_data.csv.
+"""Gathers test data by playing SVT Play videos in
+svtplay_video_paths.txt and stores the segments as well
+as the received times in svtplay_test_data.csv and
+svtplay_test_data.bin. Several videos can play at once,
+their flows are told apart in a single shared capture by
+the local ports the browser of each video has open.
 """
 
 import argparse
 from utils import network
+from functools import partial
+from os import path
+from time import monotonic
 import requests
 import random
 import csv
-import video_player
-from threading import Thread, Timer, Event
+import json
+import os
+import platform
+import queue
+import selectors
+import corpus
+from threading import Thread, Event
 
 PLAYBACK_TIME = 600
 BUFFER_TIME = 60
 SEGMENT_TIME_THRESHOLD = 2
+READ_TIMEOUT = 10
+POLL_INTERVAL = 0.5
+READ_SIZE = 65536
+START_INTERVAL = 15
+REPLAY_TEST_DATA_CSV = 'replayed_test_data.csv'
 
-def run(interface):
-    
-    try:
-        with open('svtplay_video_paths.txt', 'r') as file:
-            video_urls = ['https://www.svtplay.se' + path.strip() 
-                for path in file.readlines()]
-    except FileNotFoundError:
-        videos = requests.get(
-            'https://svtscraper.herokuapp.com/videos/all').json()
-        video_urls = [video['url'] for video in videos]
-    
-    capture_filter = ('src ' + ' or src '.join(network.get_svtplay_ips()) 
-        + ' and greater 0')
-    
+class Session:
+    """A video played in a browser and the segments of its flows."""
+    def __init__(self, title, svt_id, start_time, url=None):
+        self.title = title
+        self.svt_id = svt_id
+        self.start_time = start_time
+        self.url = url
+        self.flows = []
+        # Process id of the browser's driver, the browser runs below it
+        self.browser_pid = None
+        # When its flows last had packets, by the clock of the gatherer
+        self.read_at = None
+        self.exit_flag = Event()
+        self.segments = []
+        self.segment_times = []
+        self._init_time = None
+        self._last_active = None
+        self._current_segment = 0
+
+    def play(self):
+        """Plays the video in a background thread until the playback time
+        has passed or the exit flag is set, which is set when it ends.
+        """
+        import video_player
+
+        def on_start(driver):
+            self.browser_pid = driver.service.process.pid
+
+        def play():
+            try:
+                video_player.play_video(self.url, PLAYBACK_TIME,
+                                        self.exit_flag, on_start)
+            finally:
+                self.exit_flag.set()
+
+        Thread(target=play).start()
+
+    def add_packet(self, time, size):
+        if self._init_time is None:
+            self._init_time = self._last_active = time
+            self._current_segment = size
+            return
+
+        time_elapsed = round(self._last_active - self._init_time, 1)
+
+        if time - self._last_active > SEGMENT_TIME_THRESHOLD:
+            self.segments.append(self._current_segment)
+            self.segment_times.append(time_elapsed)
+            self._current_segment = 0
+
+        self._last_active = time
+        self._current_segment += size
+
+    def save(self, csv_path=corpus.TEST_DATA_CSV,
+             bin_path=corpus.TEST_DATA_BIN):
+        with (open(csv_path, 'a', newline='', encoding='utf8')
+                as csv_file):
+            writer = csv.writer(csv_file)
+            segment_data = list(zip(self.segments, self.segment_times))
+            writer.writerow([self.title, self.svt_id, self.start_time] +
+                            segment_data)
+        corpus.append_test_data(self.title, self.svt_id, self.start_time,
+                                self.segments, self.segment_times, bin_path)
+
+class FlowDemultiplexer:
+    """Splits the packets of a shared capture into the flows of the
+    sessions. The first packet of an unknown flow asks find_owner for the
+    session owning its local port. Without find_owner every new flow
+    belongs to the only session, like a capture of a single browser.
+    """
+    def __init__(self, find_owner=None):
+        self._find_owner = find_owner
+        self._sessions = []
+        # Flows of ended or unknown sessions map to None and are ignored
+        self._flows = {}
+        self.unclaimed_packets = 0
+
+    def add(self, session):
+        self._sessions.append(session)
+
+    def remove(self, session):
+        """Stops handing packets to the session."""
+        self._sessions.remove(session)
+        for flow in session.flows:
+            self._flows[flow] = None
+
+    def feed(self, packets):
+        """Hands (src, dst, port, time, size) packets to the sessions of
+        their flows, returns the sessions which received packets.
+        """
+        fed = set()
+        for src, dst, port, time, size in packets:
+            flow = (src, dst, port)
+            if flow not in self._flows:
+                self._flows[flow] = self._owner(port)
+                if self._flows[flow] is not None:
+                    self._flows[flow].flows.append(flow)
+            session = self._flows[flow]
+            if session is None:
+                self.unclaimed_packets += 1
+                continue
+            session.add_packet(time, size)
+            fed.add(session)
+        return fed
+
+    def _owner(self, port):
+        if self._find_owner is not None:
+            return self._find_owner(port)
+        if len(self._sessions) == 1:
+            return self._sessions[0]
+        return None
+
+def browser_owner(sessions):
+    """Returns find_owner for FlowDemultiplexer, which looks up the session
+    whose browser process tree has a TCP connection from the local port.
+    Needs psutil.
+    """
+    import psutil
+
+    def find_owner(port):
+        for session in sessions:
+            if session.browser_pid is None:
+                continue
+            try:
+                driver = psutil.Process(session.browser_pid)
+                processes = [driver] + driver.children(recursive=True)
+            except psutil.Error:
+                continue
+            for process in processes:
+                try:
+                    # net_connections replaced connections in psutil 6
+                    connections = (getattr(process, 'net_connections', None)
+                                   or process.connections)(kind='tcp')
+                except psutil.Error:
+                    continue
+                if any(connection.laddr and connection.laddr.port == port
+                       for connection in connections):
+                    return session
+        return None
+
+    return find_owner
+
+def read_packets(packet_analyzer, exit_flag, timeout=READ_TIMEOUT):
+    """Yields lists of (src, dst, port, time, size) of the packets the
+    packet analyzer has printed, read in bulk whenever its output is
+    readable, and an empty list after every poll interval without packets.
+    Stops when the analyzer exits, when exit_flag is set or when nothing
+    has been read for timeout seconds, never if timeout is None.
+    """
+    return _parse_chunks(_read_chunks(packet_analyzer.stdout.fileno(),
+                                      exit_flag, timeout))
+
+def replay_packets(file_path):
+    """Yields lists of (src, dst, port, time, size) of the packets of
+    tcpdump text output or a pcap file.
+    """
+    if file_path.endswith('.pcap'):
+        reader = network.get_packet_reader(file_path)
+        try:
+            yield from read_packets(reader, Event(), timeout=None)
+        finally:
+            reader.kill()
+        return
+    with open(file_path, 'rb') as file:
+        yield from _parse_chunks(iter(partial(file.read, READ_SIZE), b''))
+
+def _parse_chunks(chunks):
+    remainder = b''
+    for chunk in chunks:
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        packets = []
+        for line in lines:
+            try:
+                packets.append(
+                    network.format_packet_with_port(line.decode('utf8')))
+            except (ValueError, IndexError):
+                continue
+        yield packets
+
+def _read_chunks(fd, exit_flag, timeout):
+    """Yields what is read from fd, empty after a poll without output."""
+    if platform.system() == 'Windows':
+        # Pipes cannot be selected on Windows, one thread reads instead
+        yield from _read_chunks_in_thread(fd, exit_flag, timeout)
+        return
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        read_at = monotonic()
+        while not exit_flag.is_set():
+            if timeout is not None and monotonic() - read_at > timeout:
+                return
+            if not selector.select(POLL_INTERVAL):
+                yield b''
+                continue
+            chunk = os.read(fd, READ_SIZE)
+            if not chunk:
+                return
+            read_at = monotonic()
+            yield chunk
+
+def _read_chunks_in_thread(fd, exit_flag, timeout):
+    chunks = queue.SimpleQueue()
+
+    def read():
+        while True:
+            chunk = os.read(fd, READ_SIZE)
+            chunks.put(chunk)
+            if not chunk:
+                return
+
+    Thread(target=read, daemon=True).start()
+    read_at = monotonic()
+    while not exit_flag.is_set():
+        if timeout is not None and monotonic() - read_at > timeout:
+            return
+        try:
+            chunk = chunks.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            yield b''
+            continue
+        if not chunk:
+            return
+        read_at = monotonic()
+        yield chunk
+
+def get_sessions(video_urls):
+    """Yields a session at a random position of every video long enough
+    for the playback time.
+    """
     for url in video_urls:
         svt_id = url[-7:]
         metadata = requests.get(f'https://api.svt.se/video/{svt_id}').json()
@@ -36,7 +268,7 @@ def run(interface):
             title = metadata['programTitle']
             episode_title = metadata['episodeTitle']
             if episode_title != title:
-                title += f": {episode_title}" 
+                title += f": {episode_title}"
             duration = int(metadata['contentDuration'])
         except (TypeError, KeyError):
             continue
@@ -45,75 +277,138 @@ def run(interface):
             continue
 
         start_time = random.randint(0, duration - PLAYBACK_TIME - BUFFER_TIME)
-        url += f'&position={start_time}'
-
-        stream = ()
-        segments = []
-        segment_times = []
-        current_segment = 0
-
-        packet_analyzer = network.get_packet_analyzer(capture_filter, 
-            interface)
-        exit_flag = Event()
-        interuppted = False
-        player = Thread(target=video_player.play_video, 
-            args=(url, PLAYBACK_TIME, exit_flag))
-        player.start()
-        
-        while player.is_alive(): 
-            try:
-                timer = Timer(10, packet_analyzer.terminate)
-                timer.start()
-                packet = packet_analyzer.stdout.readline()
-                
-                try:
-                    src, dst, time, size = network.format_packet(packet)
-                except Exception:
-                    break
-                
-                if not stream:
-                    stream = (src, dst)
-                    init_time = last_active = time
-                    current_segment = size
-                    continue
+        yield Session(title, svt_id, start_time,
+                      url + f'&position={start_time}')
+
+def run(interface, sessions=1, start_interval=START_INTERVAL,
+        csv_path=corpus.TEST_DATA_CSV):
+
+    try:
+        with open('svtplay_video_paths.txt', 'r') as file:
+            video_urls = ['https://www.svtplay.se' + path.strip()
+                for path in file.readlines()]
+    except FileNotFoundError:
+        videos = requests.get(
+            'https://svtscraper.herokuapp.com/videos/all').json()
+        video_urls = [video['url'] for video in videos]
 
-                time_elapsed = round(last_active-init_time, 1)
-            
-                if time - last_active > SEGMENT_TIME_THRESHOLD:
-                    segments.append(current_segment)
-                    segment_times.append(time_elapsed)
-                    current_segment = 0
+    capture_filter = network.get_capture_filter(network.get_svtplay_ips())
+    packet_analyzer = network.get_packet_analyzer(capture_filter, interface)
+    bin_path = _bin_path(csv_path)
+    pending = get_sessions(video_urls)
+    playing = []
+    # A single session records every flow of the capture, like a capture
+    # of one browser, concurrent ones only the flows of their browser
+    demultiplexer = FlowDemultiplexer(browser_owner(playing) if sessions > 1
+                                      else None)
+    last_start = None
 
-                last_active = time
-                current_segment += size
+    def end(session):
+        session.exit_flag.set()
+        demultiplexer.remove(session)
+        playing.remove(session)
+        session.save(csv_path, bin_path)
 
-            except KeyboardInterrupt:
-                exit_flag.set()
-                interuppted = True
-                print("Interuppted. Quitting testing...")
-                break
+    try:
+        for packets in read_packets(packet_analyzer, Event(), timeout=None):
+            now = monotonic()
+            for session in demultiplexer.feed(packets):
+                session.read_at = now
 
-            finally:
-                timer.cancel()
+            # Sessions whose flow stalls end like those done playing
+            for session in [session for session in playing
+                            if session.exit_flag.is_set() or
+                            (session.read_at is not None and
+                             now - session.read_at > READ_TIMEOUT)]:
+                end(session)
 
-        exit_flag.set()
+            if len(playing) < sessions and (last_start is None or
+                    now - last_start >= start_interval):
+                session = next(pending, None)
+                if session is None:
+                    if not playing:
+                        break
+                    continue
+                demultiplexer.add(session)
+                session.play()
+                playing.append(session)
+                last_start = now
+
+    except KeyboardInterrupt:
+        print("Interuppted. Quitting testing...")
+
+    finally:
+        for session in list(playing):
+            end(session)
         packet_analyzer.kill()
-        with (open('svtplay_test_data.csv', 'a', newline='', encoding='utf8')
-                as csv_file):
-            writer = csv.writer(csv_file)
-            segment_data = list(zip(segments, segment_times))
-            writer.writerow([title, svt_id, start_time] + segment_data)
 
-        if interuppted:
-            break
+def replay(file_path, truth_path, csv_path=REPLAY_TEST_DATA_CSV):
+    """Gathers the flows of a replayed capture of the traffic generator,
+    standing in for browser sessions which own the ports of the flows, and
+    returns the amount of sessions which got exactly their own flow.
+    """
+    with open(truth_path, encoding='utf8') as json_file:
+        truth = json.load(json_file)
+    bin_path = _bin_path(csv_path)
+    sessions = {}
+    for flow in truth:
+        sessions[flow["Port"]] = Session(flow["Video id"], flow["Video id"],
+                                         flow["First segment"])
+    demultiplexer = FlowDemultiplexer(sessions.get)
+    for session in sessions.values():
+        demultiplexer.add(session)
+
+    for packets in replay_packets(file_path):
+        demultiplexer.feed(packets)
+
+    claimed = 0
+    for flow in truth:
+        session = sessions[flow["Port"]]
+        demultiplexer.remove(session)
+        session.save(csv_path, bin_path)
+        if session.flows == [(flow["IP src"], flow["IP dst"], flow["Port"])]:
+            claimed += 1
+    return claimed
+
+def _bin_path(csv_path):
+    return path.splitext(csv_path)[0] + '.bin'
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Plays videos and gathers segment test data from" +
             " SVT Play in real-time.")
-    parser.add_argument("-i", "--interface", 
-        help="Network interface to run the test data gatherer on.",
-        required=True)
+    parser.add_argument("-i", "--interface",
+        help="Network interface to run the test data gatherer on, " +
+            "required unless --read-file is given.")
+    parser.add_argument("-n", "--sessions",
+        help="Amount of videos played at the same time, more than one " +
+            "needs psutil to find the browser of each flow.",
+        type=int,
+        default=1)
+    parser.add_argument("--start-interval",
+        help="Seconds between starting sessions.",
+        type=float,
+        default=START_INTERVAL)
+    parser.add_argument("-o", "--output",
+        help="CSV file the test data is appended to, the binary test " +
+            "data is appended next to it. Defaults to " +
+            f"{corpus.TEST_DATA_CSV}, or {REPLAY_TEST_DATA_CSV} with " +
+            "--read-file.")
+    parser.add_argument("--read-file",
+        help="Gather the flows of traffic_generator.py output instead " +
+            "of playing videos.")
+    parser.add_argument("--truth",
+        help="Ground truth file of the traffic generator output.",
+        default='traffic_truth.json')
     args = parser.parse_args()
-    interface = args.interface
-    run(interface)
\ No newline at end of file
+    if not args.interface and not args.read_file:
+        parser.error("the following arguments are required: -i/--interface")
+    if args.read_file:
+        # Replayed traffic never ends up in the real test data by default
+        output = args.output or REPLAY_TEST_DATA_CSV
+        claimed = replay(args.read_file, args.truth, output)
+        print(f"{claimed} sessions got exactly their own flow, test data " +
+            f"written to {output}")
+    else:
+        run(args.interface, args.sessions, args.start_interval,
+            args.output or corpus.TEST_DATA_CSV)
@@ -0,0 +1,108 @@
+"""Synthetic SVT Play catalogs for benchmarks. Every video has a scene
+complexity which varies slowly from segment to segment, and one
+fingerprint per quality level whose segment sizes follow the complexity
+at the level's bitrate, like the encodings of a real video.
+"""
+
+import numpy as np
+
+SEGMENT_LENGTH = 3.84
+QUALITY_BITRATES = (0.4e6, 1.1e6, 2.5e6, 4.5e6, 7.5e6)
+MIN_SEGMENT_SIZE = 5000
+MAX_SEGMENT_SIZE = 9000000
+MIN_DURATION = 120
+MAX_DURATION = 3600
+COMPLEXITY_SIGMA = 0.35
+COMPLEXITY_CORRELATION = 0.8
+
+def generate_catalog(videos=1000, min_duration=MIN_DURATION,
+                     max_duration=MAX_DURATION,
+                     qualities=len(QUALITY_BITRATES),
+                     complexity_sigma=COMPLEXITY_SIGMA,
+                     complexity_correlation=COMPLEXITY_CORRELATION, seed=0):
+    """Returns a catalog in the layout of db.load_csv_db. Durations are
+    uniform in seconds, the complexity of a segment is log-normal with the
+    given sigma and correlation with the previous segment. Every video has
+    the given amount of the highest qualities.
+    """
+    if not 1 <= qualities <= len(QUALITY_BITRATES):
+        raise ValueError("the amount of qualities has to be between 1 and " +
+            f"{len(QUALITY_BITRATES)}!")
+    if not 0 < min_duration <= max_duration:
+        raise ValueError("the minimum duration has to be positive and at " +
+            "most the maximum duration!")
+    rng = np.random.default_rng(seed)
+    catalog = {}
+    for video_number in range(videos):
+        duration = int(rng.integers(min_duration, max_duration + 1))
+        segment_amount = max(1, round(duration / SEGMENT_LENGTH))
+        complexity = np.exp(_autoregressive(rng, segment_amount,
+                                            complexity_sigma,
+                                            complexity_correlation))
+        fingerprints = []
+        for bitrate in QUALITY_BITRATES[-qualities:]:
+            # Encoders deviate a little from the complexity per quality
+            deviation = rng.normal(1, 0.02, segment_amount)
+            sizes = bitrate * SEGMENT_LENGTH / 8 * complexity * deviation
+            sizes = np.clip(np.round(sizes), MIN_SEGMENT_SIZE,
+                            MAX_SEGMENT_SIZE).astype(np.int64)
+            fingerprints.append(tuple(sizes.tolist()))
+        catalog[f'synthetic{video_number}'] = {
+            'name': f'Synthetic video {video_number}',
+            'duration': duration,
+            'segment_length': SEGMENT_LENGTH,
+            'fingerprints': tuple(fingerprints)
+        }
+    return catalog
+
+def sample_windows(catalog, window_width, amount, noise=0.002, seed=0):
+    """Returns (video id, window) pairs of random windows of the catalog,
+    with segment sizes off by the given relative noise like captured
+    segments.
+    """
+    rng = np.random.default_rng(seed)
+    fingerprints = [(video_id, fingerprint)
+                    for video_id, video in catalog.items()
+                    for fingerprint in video['fingerprints']
+                    if len(fingerprint) >= window_width]
+    if not fingerprints:
+        raise ValueError("no fingerprint is as long as the window width!")
+    windows = []
+    for _ in range(amount):
+        video_id, fingerprint = fingerprints[rng.integers(len(fingerprints))]
+        start = int(rng.integers(len(fingerprint) - window_width + 1))
+        window = np.array(fingerprint[start:start + window_width])
+        window = np.round(window * rng.normal(1, noise, window_width))
+        windows.append((video_id, window.astype(np.int64).tolist()))
+    return windows
+
+def sample_streams(catalog, amount, segments=150, noise=0.002, seed=0):
+    """Returns captured streams of random fingerprints in the layout of
+    tests.load_test_videos, {(name, id, start): (segments, times)}, with
+    segment sizes off by the given relative noise.
+    """
+    rng = np.random.default_rng(seed)
+    fingerprints = [(video_id, fingerprint)
+                    for video_id, video in catalog.items()
+                    for fingerprint in video['fingerprints']]
+    streams = {}
+    for _ in range(amount):
+        video_id, fingerprint = fingerprints[rng.integers(len(fingerprints))]
+        length = min(segments, len(fingerprint))
+        start = int(rng.integers(len(fingerprint) - length + 1))
+        sizes = np.array(fingerprint[start:start + length])
+        sizes = np.round(sizes * rng.normal(1, noise, length))
+        times = SEGMENT_LENGTH * np.arange(1, length + 1)
+        streams[(catalog[video_id]['name'], video_id,
+                 str(round(start * SEGMENT_LENGTH)))] = (
+            sizes.astype(np.int64).tolist(), times.tolist())
+    return streams
+
+def _autoregressive(rng, length, sigma, correlation):
+    values = np.empty(length)
+    innovation = sigma * np.sqrt(1 - correlation**2)
+    values[0] = rng.normal(0, sigma)
+    noise = rng.normal(0, innovation, length)
+    for i in range(1, length):
+        values[i] = correlation * values[i - 1] + noise[i]
+    return values
@@ -0,0 +1,72 @@
+"""Tests the evidence voting of identifier.py when tracking a stream is lost
+mid-stream. Run with pytest.
+"""
+
+from os import path
+import importlib.util
+import sys
+
+SRC_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+IDENTIFIER_DIR = path.join(SRC_DIR, 'identifier')
+sys.path[:0] = [SRC_DIR]
+# identifier.py imports db as a module of its own directory
+sys.path.append(IDENTIFIER_DIR)
+_spec = importlib.util.spec_from_file_location(
+    'identifier_script', path.join(IDENTIFIER_DIR, 'identifier.py'))
+identifier = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(identifier)
+db = identifier.db
+
+VIDEO = ('video', 0)
+
+class ScriptedDB:
+    """Stands in for IdentificationDB, the tracked positions match while
+    tracking holds and every vote has the given candidates.
+    """
+    def __init__(self):
+        self.tracking = True
+        self.candidates = []
+
+    def verify(self, window, positions, pearson_threshold):
+        if not self.tracking:
+            return []
+        return [({'id': video_id}, (video_id, fingerprint_index,
+                                   window_index))
+                for video_id, fingerprint_index, window_index in positions]
+
+    def vote(self, window, voting, pearson_threshold):
+        voted = voting.add(self.candidates)
+        return [({'id': position[0]}, position)
+                for pearsons_r, position in self.candidates
+                if pearsons_r > pearson_threshold or position in voted]
+
+def test_votes_align_after_tracking_is_lost():
+    pearson_threshold = 0.999
+    voting = db.EvidenceVoting(0.9999, min_r=0.99)
+    flow = identifier.Stream(1, 0, 0, 4, voting)
+    identification_db = ScriptedDB()
+    identification_db.tracking = False
+
+    # Window 10 of the video is below the threshold on its own, window 11
+    # passes it and the stream is tracked from there
+    identification_db.candidates = [(0.995, (*VIDEO, 10))]
+    assert identifier.identify(identification_db, flow, (),
+                               pearson_threshold) == []
+    identification_db.candidates = [(0.9995, (*VIDEO, 11))]
+    assert identifier.identify(identification_db, flow, (),
+                               pearson_threshold) == [{'id': 'video'}]
+
+    identification_db.tracking = True
+    for window_index in range(12, 15):
+        assert identifier.identify(identification_db, flow, (),
+                                   pearson_threshold) == [{'id': 'video'}]
+        assert flow.tracked == [(*VIDEO, window_index)]
+    assert voting.expected_positions() == [(*VIDEO, 15)]
+
+    # Tracking is lost, a window below the threshold at the position the
+    # stream has reached is matched by the votes from before tracking
+    identification_db.tracking = False
+    identification_db.candidates = [(0.995, (*VIDEO, 15))]
+    assert identifier.identify(identification_db, flow, (),
+                               pearson_threshold) == [{'id': 'video'}]
+    assert flow.tracked == [(*VIDEO, 15)]
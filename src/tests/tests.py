@@ -1,62 +1,171 @@
-from utils import format
+from utils import format, profiling
+from contextlib import nullcontext
 from collections import deque
-import csv
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 import argparse
 from tqdm import tqdm
-from identifier import db
+from identifier import db, daemon
 from timeit import default_timer as timer
+from os import path
+from numpy.lib.stride_tricks import sliding_window_view
+import numpy as np
+import corpus
 import json
-import ast
+import os
 import sys
 import tracemalloc
 
-def identification_tests(window_widths, kd_dimensions, pearson_thresholds):
+# Set before the worker processes are forked, which share them copy-on-write
+_catalog = None
+_test_videos = None
 
-    test_videos = {}
-    seen_ids = set()
+def identification_tests(window_widths, kd_dimensions, pearson_thresholds,
+        daemon_socket=None, workers=1, resume=False):
+    global _catalog, _test_videos
 
     print("Reading database file...")
-    csv_db = db.load_csv_db()
+    csv_db = corpus.unpack_catalog(corpus.load_catalog())
 
     print("Reading test data file...")
-    with open('svtplay_test_data.csv', encoding='utf8') as test_file:
-        reader = csv.reader(test_file)
-        for row in reader:
-            svt_id = row[1]
-            first_segment_time = float(ast.literal_eval(row[3])[1])
-            last_segment_time = float(ast.literal_eval(row[-1])[1])
-            _, db_ids = csv_db
-            if (svt_id not in db_ids or svt_id in seen_ids or 
-                    first_segment_time > 15  or last_segment_time < 500):
-                continue
-            seen_ids.add(row[1])
-            video = tuple(row[:3])
-            segments_times = row[3:]
-            test_videos[video] = segments_times
-
-    for window_width in window_widths:
-        for kd_dimension in kd_dimensions:
-            print(f"Initializing database with window width {window_width} " +
-                f"and k-dimension {kd_dimension}...")
-            try:
+    test_videos = load_test_videos(csv_db)
+
+    if daemon_socket:
+        # The daemon's index is tested instead of building one per config
+        identification_db = daemon.IdentificationClient(daemon_socket)
+        _identification_test(test_videos, identification_db,
+            identification_db.window_width, identification_db.k_dimension,
+            pearson_thresholds, 0)
+        identification_db.close()
+        return
+
+    configs = [(window_width, kd_dimension)
+               for window_width in window_widths
+               for kd_dimension in kd_dimensions]
+    if resume:
+        configs = [config for config in configs
+                   if not path.exists(_report_path(*config))]
+        print(f"Resuming with {len(configs)} configurations left...")
+
+    _catalog = csv_db
+    _test_videos = test_videos
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        print("Processes cannot be forked on this platform, testing the " +
+            "configurations one at a time...")
+        workers = 1
+    if workers == 1:
+        for window_width, kd_dimension in configs:
+            _identification_config(window_width, kd_dimension,
+                                   pearson_thresholds)
+        return
+
+    # Forked workers inherit the parsed catalog instead of unpickling it
+    with ProcessPoolExecutor(max_workers=workers,
+            mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {executor.submit(_identification_config, window_width,
+                                   kd_dimension, pearson_thresholds, False):
+                   (window_width, kd_dimension)
+                   for window_width, kd_dimension in configs}
+        for future in (pbar := tqdm(as_completed(futures),
+                                    total=len(futures))):
+            window_width, kd_dimension = futures[future]
+            pbar.set_description(f"Window width {window_width}, " +
+                f"k-dimension {kd_dimension} done")
+            future.result()
+
+def _identification_config(window_width, kd_dimension, pearson_thresholds,
+        progress=True):
+    """Builds the database for one configuration and tests it."""
+    print(f"Initializing database with window width {window_width} " +
+        f"and k-dimension {kd_dimension}...")
+    try:
+        start = timer()
+        tracemalloc.start()
+        # Without the cache every query searches the tree, comparable with
+        # reports of earlier versions
+        identification_db = db.IdentificationDB(window_width,
+            kd_dimension, _catalog, cache_size=0)
+        mem, _ = tracemalloc.get_traced_memory()
+    except ValueError as e:
+        print("Error:", e, "Continuing...")
+        return
+    finally:
+        tracemalloc.stop()
+        end = timer()
+    print(f"Done in {round(end - start, 1)} seconds.")
+
+    _identification_test(_test_videos, identification_db,
+        window_width, kd_dimension, pearson_thresholds, mem, progress)
+
+def load_test_videos(catalog):
+    """Returns {(title, id, start time): (segments, times)} of the test
+    videos in the catalog, captured from their start for at least 500 s.
+    """
+    test_videos = {}
+    seen_ids = set()
+    for title, svt_id, start_time, sizes, times in corpus.videos(
+            corpus.load_test_data()):
+        if (svt_id not in catalog or svt_id in seen_ids or not len(times) or
+                times[0] > 15 or times[-1] < 500):
+            continue
+        seen_ids.add(svt_id)
+        segments = np.round(sizes / 1.0018 - 801).astype(np.int64)
+        test_videos[(title, svt_id, start_time)] = (segments.tolist(),
+                                                    times.tolist())
+    return test_videos
+
+def replay(test_videos, identification_db, window_width, pearson_thresholds,
+        progress=True):
+    """Replays the test videos, returns {video: (id, records, last time)}
+    and the query times. Records are (pearsons_r, time, best match) of the
+    windows matching better than all earlier windows of the video.
+    """
+    # Every window is queried once at the lowest threshold. A threshold is
+    # passed first by the first window matching better than all earlier
+    # windows above it, so only those windows are recorded, and a video is
+    # done once a window passes the highest threshold.
+    min_threshold = min(pearson_thresholds)
+    max_threshold = max(pearson_thresholds)
+    outcomes = {}
+    query_times = []
+
+    for video, (segments, times) in (pbar := tqdm(test_videos.items(),
+                                                  disable=not progress)):
+
+        title, svt_id, start_time = video
+        pbar.set_description(title)
+        tested_video = f"{title}, {svt_id}, {start_time} s"
+        sliding_window = deque(maxlen=window_width)
+        records = []
+
+        for segment, time in zip(segments, times):
+            sliding_window.append(segment)
+            if len(sliding_window) == window_width:
                 start = timer()
-                tracemalloc.start()
-                identification_db = db.IdentificationDB(window_width, 
-                    kd_dimension, csv_db)
-                mem, _ = tracemalloc.get_traced_memory()
-            except ValueError as e:
-                print("Error:", e, "Continuing...")
-                continue
-            finally:
-                tracemalloc.stop()
+                found = identification_db.identify(sliding_window, min_threshold)
                 end = timer()
-            print(f"Done in {round(end - start, 1)} seconds.")
+                query_times.append(end - start)
+                if found:
+                    best = max(found, key=lambda match: match['pearsons_r'])
+                    if not records or best['pearsons_r'] > records[-1][0]:
+                        records.append((best['pearsons_r'], time, best))
+                    if best['pearsons_r'] > max_threshold:
+                        break
+
+        outcomes[tested_video] = (svt_id, records, time)
+
+    return outcomes, query_times
 
-            _identification_test(test_videos, identification_db, 
-                window_width, kd_dimension, pearson_thresholds, mem)
+def first_match(records, pearson_threshold):
+    """Returns the record of the first window passing the threshold."""
+    return next((record for record in records
+                 if record[0] > pearson_threshold), None)
+
+def _report_path(window_width, kd_dimension):
+    return f'identification_test_{window_width}_{kd_dimension}.json'
 
 def _identification_test(test_videos, identification_db, window_width, 
-        kd_dimension, pearson_thresholds, mem):
+        kd_dimension, pearson_thresholds, mem, progress=True):
 
     tested = {
         "Videos tested": len(test_videos),
@@ -65,59 +174,43 @@ def _identification_test(test_videos, identification_db, window_width,
         "Allocated memory": format.convert_size(mem)}
 
     pearson_thresholds_tests = {}
-    query_times = []
+    outcomes, query_times = replay(test_videos, identification_db,
+        window_width, pearson_thresholds, progress)
+
+    for pearson_threshold in pearson_thresholds:
 
-    for pearson_threshold in (pbar := tqdm(pearson_thresholds)):
-        pbar.set_description(f"Pearson's r threshold {pearson_threshold}")
-  
         matches = {}
         false_matches = {}
         no_matches = {}
         match_times = []
         fastest_time = 600
         slowest_time = 0
-        
-        for video, segments_times in test_videos.items():
-
-            title, svt_id, start_time = video
-            tested_video = f"{title}, {svt_id}, {start_time} s"
-            sliding_window = deque(maxlen=window_width)
-
-            for segment_time in segments_times:
-                captured_segment, time = ast.literal_eval(segment_time)
-                time = float(time)
-                segment = round((int(captured_segment) / 1.0018) - 801)
-                sliding_window.append(segment)
-                if len(sliding_window) == window_width:
-                    start = timer()
-                    match = identification_db.identify(sliding_window, pearson_threshold)
-                    end = timer()
-                    query_times.append(end - start)
-                    if match:
-                        matched_title, _, matched_id, _, matched_quality, \
-                            matched_time, pearsons_r = match
-                        matched_time = f'{matched_time[:-1]} s'
-                        match = {
-                            "Time to match": f'{time} s',
-                            "Matched title": matched_title, 
-                            "Matched SVT id": matched_id,
-                            "Matched quality": matched_quality,
-                            "Matched timestamp": matched_time,
-                            "Pearson's r": pearsons_r}
-                    
-                        if svt_id == matched_id:
-                            match_times.append(time)
-                            if time > slowest_time:
-                                slowest_time = time
-                            if time < fastest_time:
-                                fastest_time = time
-                            matches[tested_video] = match
-                        else:
-                            false_matches[tested_video] = match
-                        break
-            else:
+
+        for tested_video, (svt_id, records, last_time) in outcomes.items():
+            record = first_match(records, pearson_threshold)
+            if record is None:
                 no_matches[tested_video] = {
-                    "No match after": f'{time} s'}
+                    "No match after": f'{last_time} s'}
+                continue
+
+            pearsons_r, time, best = record
+            matched_id = best['id']
+            match = {
+                "Time to match": f'{time} s',
+                "Matched title": best['name'],
+                "Matched SVT id": matched_id,
+                "Matched timestamp": f"{round(best['time'], 1)} s",
+                "Pearson's r": pearsons_r}
+
+            if svt_id == matched_id:
+                match_times.append(time)
+                if time > slowest_time:
+                    slowest_time = time
+                if time < fastest_time:
+                    fastest_time = time
+                matches[tested_video] = match
+            else:
+                false_matches[tested_video] = match
 
         match_percentage = f'{round((len(matches) / len(test_videos)) * 100, 1)}%' if len(test_videos) else None
         false_match_percentage = f'{round((len(false_matches) / len(test_videos)) * 100, 1)}%' if len(test_videos) else None
@@ -144,46 +237,100 @@ def _identification_test(test_videos, identification_db, window_width,
     tested['Average query time'] = average_query_time
     tested["Pearson's r thresholds"] = pearson_thresholds_tests
 
-    with (open(f'identification_test_{window_width}_{kd_dimension}.json', 
-            'w', encoding='utf8') as json_file):
+    # Written to a temporary file first, a resumed sweep only skips
+    # complete reports
+    report_path = _report_path(window_width, kd_dimension)
+    with open(report_path + '.tmp', 'w', encoding='utf8') as json_file:
         json.dump(tested, json_file, indent=4)
+    os.replace(report_path + '.tmp', report_path)
+
+# Odd, so that it has an inverse modulo 2^64
+WINDOW_HASH_BASE = 0x9E3779B97F4A7C15
 
 def windows_uniqueness_tests(window_widths):
 
     print("Reading database file...")
-    video_segments, _ = db.load_csv_db()
+    catalog = corpus.load_catalog()
+    segments = catalog['segments']
+    offsets = catalog['offsets']
+
+    # Polynomial hashes of all windows of all widths from one prefix sum,
+    # prefix[i] = sum of segments[j] * base^-j for j < i modulo 2^64, and
+    # the hash of the window of width w at p is
+    # (prefix[p + w] - prefix[p]) * base^p = sum of segments[p + j] * base^-j
+    inverse = pow(WINDOW_HASH_BASE, -1, 2**64)
+    with np.errstate(over='ignore'):
+        powers = np.cumprod(np.full(len(segments), WINDOW_HASH_BASE,
+                                    dtype=np.uint64)) * np.uint64(inverse)
+        inverse_powers = np.cumprod(np.full(len(segments), inverse,
+                                            dtype=np.uint64)) * \
+            np.uint64(WINDOW_HASH_BASE)
+        prefix = np.zeros(len(segments) + 1, dtype=np.uint64)
+        np.cumsum(segments.astype(np.uint64) * inverse_powers,
+                  out=prefix[1:])
+    fingerprint_ends = np.repeat(offsets[1:], np.diff(offsets))
+
     for window_width in (pbar := tqdm(window_widths)):
         pbar.set_description(f"Window width {window_width}")
-        _windows_uniqueness_test(video_segments, window_width)
+        _windows_uniqueness_test(catalog, window_width, prefix, powers,
+                                 fingerprint_ends)
 
-def _windows_uniqueness_test(video_segments, window_width):
+def _windows_uniqueness_test(catalog, window_width, prefix, powers,
+        fingerprint_ends):
 
-    windows = {}
-    windows_tested = 0
-    duplicate_windows = {}
-    
-    for video, segments in video_segments.items():
-        title, _, svt_id, _, quality = video
-        sliding_window = deque(maxlen=window_width)
-        window_index = 0
-        for segment in segments:
-            sliding_window.append(segment)
-            if len(sliding_window) == window_width:
-                window = '[' +  ', '.join(map(str, sliding_window)) + ']'
-                window_metadata = f'{title}, {svt_id}, {quality}, Window index: {window_index}'
-                if window in windows:
-                    if duplicate_windows.get(window) is None:
-                        duplicate_windows[window] = [windows[window]]
-                    duplicate_windows[window].append(window_metadata)
-                else:
-                    windows[window] = window_metadata
-
-                window_index += 1
-                windows_tested += 1
-
-    unique_windows = windows_tested - len(duplicate_windows)
+    segments = catalog['segments']
+    starts = np.flatnonzero(np.arange(len(segments)) + window_width
+                            <= fingerprint_ends)
+    with np.errstate(over='ignore'):
+        hashes = (prefix[starts + window_width] - prefix[starts]) * \
+            powers[starts]
+
+    # Windows sharing their hash with another window are compared exactly
+    hash_order = np.argsort(hashes, kind='stable')
+    sorted_hashes = hashes[hash_order]
+    shared = np.zeros(len(starts), dtype=bool)
+    same = sorted_hashes[1:] == sorted_hashes[:-1]
+    shared[1:] |= same
+    shared[:-1] |= same
+    candidates = np.sort(starts[hash_order[shared]])
+
+    rows = sliding_window_view(segments, window_width)[candidates]
+    order = np.lexsort((candidates, *rows.T[::-1]))
+    rows = rows[order]
+    candidates = candidates[order]
+    group_starts = np.flatnonzero(np.concatenate(([True],
+        np.any(rows[1:] != rows[:-1], axis=1), [True])))
+    group_sizes = np.diff(group_starts)
+    duplicate_groups = np.flatnonzero(group_sizes > 1)
+
+    windows_tested = len(starts)
+    duplicate_windows = len(duplicate_groups)
+    unique_windows = windows_tested - duplicate_windows
     unique_window_percentage = f'{((unique_windows / windows_tested) * 100):.20f}%' if windows_tested else None
-    duplicate_window_percentage = f'{((len(duplicate_windows) / windows_tested) * 100):.20f}%' if windows_tested else None
+    duplicate_window_percentage = f'{((duplicate_windows / windows_tested) * 100):.20f}%' if windows_tested else None
+
+    # Listed one duplicate window per line, as JSON lines
+    report_path = f'windows_uniqueness_test_{window_width}.jsonl'
+    offsets = catalog['offsets']
+    fingerprint_videos = catalog['fingerprint_videos']
+    with open(report_path, 'w', encoding='utf8') as report_file:
+        for group in duplicate_groups:
+            positions = candidates[group_starts[group]:
+                                   group_starts[group + 1]]
+            fingerprints = np.searchsorted(offsets, positions,
+                                           side='right') - 1
+            occurrences = []
+            for position, fingerprint_index in zip(positions.tolist(),
+                                                   fingerprints.tolist()):
+                video_number = fingerprint_videos[fingerprint_index]
+                occurrences.append({
+                    "Title": str(catalog['names'][video_number]),
+                    "SVT id": str(catalog['ids'][video_number]),
+                    "Fingerprint": fingerprint_index,
+                    "Window index": position - int(offsets[fingerprint_index])})
+            report_file.write(json.dumps({
+                "Window": rows[group_starts[group]].tolist(),
+                "Occurrences": occurrences}) + '\n')
 
     with (open(f'windows_uniqueness_test_{window_width}.json', 'w', 
             encoding='utf8') as json_file):
@@ -192,9 +339,9 @@ def _windows_uniqueness_test(video_segments, window_width):
             "Window width": window_width,
             "Unique windows": unique_windows,
             "Unique window percentage": unique_window_percentage,
-            "Duplicate windows": len(duplicate_windows),
+            "Duplicate windows": duplicate_windows,
             "Duplicate window percentage": duplicate_window_percentage,
-            "Duplicate windows list": duplicate_windows}
+            "Duplicate windows list": report_path}
         json.dump(tested, json_file, indent=4)
 
 if __name__ == "__main__":
@@ -207,20 +354,42 @@ if __name__ == "__main__":
     parser.add_argument('-w', "--window-widths",
         type=int,
         nargs='+',
-        required=True)
+        required='--daemon-socket' not in sys.argv)
     parser.add_argument('-k', "--kd-dimensions",
         type=int,
         nargs='+',
-        required='--identification' in sys.argv)
+        required=('--identification' in sys.argv and
+                  '--daemon-socket' not in sys.argv))
     parser.add_argument('-p', "--pearson-thresholds",
         type=float,
         nargs='+',
         required='--identification' in sys.argv)
+    parser.add_argument('--workers',
+        help="amount of configurations tested in parallel forked " +
+            "processes, where the platform supports forking",
+        type=int,
+        default=1)
+    parser.add_argument('--resume',
+        help="skip configurations which already have a report",
+        action=argparse.BooleanOptionalAction)
+    parser.add_argument('--daemon-socket',
+        help="test the index of the identification daemon listening on " +
+            "this socket")
+    parser.add_argument('--profile',
+        choices=profiling.MODES)
+    parser.add_argument('--profile-output',
+        default='tests_profile')
     args = parser.parse_args()
-    if args.identification:
-        identification_tests(args.window_widths, args.kd_dimensions, 
-            args.pearson_thresholds)
-    elif args.uniqueness:
-        windows_uniqueness_tests(args.window_widths)
-    else:
-        print("No tests specified...")
\ No newline at end of file
+    profiler = (profiling.Profiler(args.profile, args.profile_output)
+                if args.profile else nullcontext())
+    # Profiling follows the main process, so configurations run in it
+    workers = 1 if args.profile else args.workers
+    with profiler:
+        if args.identification:
+            identification_tests(args.window_widths, args.kd_dimensions, 
+                args.pearson_thresholds, args.daemon_socket, workers,
+                args.resume)
+        elif args.uniqueness:
+            windows_uniqueness_tests(args.window_widths)
+        else:
+            print("No tests specified...")
\ No newline at end of file
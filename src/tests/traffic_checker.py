@@ -0,0 +1,66 @@
+"""Compares the events the identifier wrote with `--output-file` while
+replaying traffic_generator.py output against the generator's ground truth.
+Every flow counts as a hit if the best match of its first matched window
+is the video it played, and as a false match otherwise.
+"""
+
+import argparse
+import json
+
+def check(events, truth):
+    """Returns the hit and false match rates of the flows of the truth
+    and the average time of the hits.
+    """
+    first_matches = {}
+    for event in events:
+        flow = (event['IP src'], event['IP dst'])
+        if event['Match'] and flow not in first_matches:
+            first_matches[flow] = event
+
+    hits = false_matches = 0
+    match_times = []
+    for flow in truth:
+        event = first_matches.get((flow["IP src"], flow["IP dst"]))
+        if event is None:
+            continue
+        best = max(event['Match'], key=lambda match: match['pearsons_r'])
+        if best['id'] == flow["Video id"]:
+            hits += 1
+            match_times.append(event['Elapsed'])
+        else:
+            false_matches += 1
+    flows = len(truth) or 1
+    return {
+        "Flows": len(truth),
+        "Hits": hits,
+        "False matches": false_matches,
+        "Unidentified": len(truth) - hits - false_matches,
+        "Hit rate": hits / flows,
+        "False match rate": false_matches / flows,
+        "Time to match": (sum(match_times) / len(match_times)
+                          if match_times else None)}
+
+def read_events(file_path):
+    with open(file_path, encoding='utf8') as events_file:
+        return [json.loads(line) for line in events_file if line.strip()]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Reports the hit and false match rates of the " +
+            "identifier on generated traffic.")
+    parser.add_argument("events",
+        help="JSON lines file written by identifier.py --output-file")
+    parser.add_argument("--truth",
+        help="ground truth file written by traffic_generator.py",
+        default='traffic_truth.json')
+    parser.add_argument('-o', "--output",
+        help="JSON file the report is also written to")
+    args = parser.parse_args()
+    with open(args.truth, encoding='utf8') as json_file:
+        truth = json.load(json_file)
+    report = check(read_events(args.events), truth)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as json_file:
+            json.dump(report, json_file, indent=4)
@@ -0,0 +1,193 @@
+"""Generates the traffic of concurrent SVT Play video flows from catalog
+fingerprints, as tcpdump text output or as a pcap file, for load testing
+the identifier with `--read-file`. Every segment is inflated by the HTTP
+headers and TLS overhead, split into packets and followed by a gap above
+the identifier's segment time threshold. The flows and the videos they
+play are written to a ground truth file.
+"""
+
+from identifier import db
+from os import path
+import argparse
+import heapq
+import json
+import random
+import struct
+import synthetic
+
+# As in identifier.py
+HTTP_HEADERS = 801
+TLS_OVERHEAD = 1.0018
+SEGMENT_TIME_THRESHOLD = 2
+
+MSS = 1448
+FLOW_RATE = 20e6
+JITTER = 0.05
+GAP_MARGIN = 0.5
+PCAP_EPOCH = 1700000000
+
+ETHERNET = struct.Struct('!6s6sH')
+IPV4 = struct.Struct('!BBHHHBBH4s4s')
+TCP = struct.Struct('!HHIIBBHHH')
+PCAP_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD = struct.Struct('<IIII')
+
+class Flow:
+    """A client playing a video from a CDN address."""
+    def __init__(self, number, video_id, fingerprint_index, first_segment,
+                 segments, start_time):
+        self.src = f'192.0.2.{number % 250 + 1}'
+        self.dst = f'10.{number // 62500 % 256}.{number // 250 % 250}.' + \
+            f'{number % 250 + 1}'
+        self.port = 49152 + number % 16384
+        self.video_id = video_id
+        self.fingerprint_index = fingerprint_index
+        self.first_segment = first_segment
+        self.segments = segments
+        self.start_time = start_time
+
+    def packets(self, segment_length, rng, mss=MSS, rate=FLOW_RATE,
+                jitter=JITTER):
+        """Yields (time, src, dst, port, size) for every packet."""
+        time = self.start_time
+        for segment in self.segments:
+            remaining = round((segment + HTTP_HEADERS) * TLS_OVERHEAD)
+            burst_start = time
+            while remaining > 0:
+                size = min(mss, remaining)
+                remaining -= size
+                yield time, self.src, self.dst, self.port, size
+                time += size * 8 / rate * rng.uniform(0.5, 1.5)
+            # Players fetch a segment about every segment length, the
+            # identifier needs an idle gap to tell segments apart
+            time = max(burst_start + segment_length,
+                       time + SEGMENT_TIME_THRESHOLD + GAP_MARGIN) + \
+                rng.uniform(0, jitter)
+
+    def truth(self):
+        return {
+            "IP src": self.src,
+            "IP dst": self.dst,
+            "Port": self.port,
+            "Start time": self.start_time,
+            "Video id": self.video_id,
+            "Fingerprint": self.fingerprint_index,
+            "First segment": self.first_segment,
+            "Segments": len(self.segments)}
+
+def generate_flows(catalog, flows, segments, start_spread, seed=0):
+    """Returns flows playing random parts of random fingerprints, starting
+    within start_spread seconds.
+    """
+    rng = random.Random(seed)
+    fingerprints = [(video_id, fingerprint_index, fingerprint)
+                    for video_id, video in catalog.items()
+                    for fingerprint_index, fingerprint
+                    in enumerate(video['fingerprints'])
+                    if len(fingerprint) >= segments]
+    if not fingerprints:
+        raise ValueError("no fingerprint has enough segments!")
+    generated = []
+    for number in range(flows):
+        video_id, fingerprint_index, fingerprint = rng.choice(fingerprints)
+        first_segment = rng.randrange(len(fingerprint) - segments + 1)
+        generated.append(Flow(number, video_id, fingerprint_index,
+            first_segment,
+            fingerprint[first_segment:first_segment + segments],
+            rng.uniform(0, start_spread)))
+    return generated
+
+def merged_packets(catalog, flows, seed=0, **options):
+    """Yields the packets of all flows in the order of their times."""
+    rng = random.Random(seed)
+    return heapq.merge(*(flow.packets(
+        catalog[flow.video_id]['segment_length'], rng, **options)
+        for flow in flows))
+
+def write_text(packets, file_path):
+    """Writes packets like `tcpdump -q -n -ttttt` prints them."""
+    with open(file_path, 'w', encoding='utf8') as file:
+        for time, src, dst, port, size in packets:
+            minutes, seconds = divmod(time, 60)
+            hours, minutes = divmod(int(minutes), 60)
+            file.write(f"{hours:02d}:{minutes:02d}:{seconds:09.6f} IP " +
+                f"{src}.443 > {dst}.{port}: tcp {size}\n")
+
+def write_pcap(packets, file_path):
+    """Writes packets as an Ethernet pcap file holding the headers of every
+    packet, with the payload left out of the capture.
+    """
+    with open(file_path, 'wb') as file:
+        file.write(PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for number, (time, src, dst, port, size) in enumerate(packets):
+            headers = (
+                ETHERNET.pack(b'\x02\x00\x00\x00\x00\x01',
+                              b'\x02\x00\x00\x00\x00\x02', 0x0800) +
+                IPV4.pack(0x45, 0, 40 + size, number % 65536, 0x4000, 64, 6,
+                          0, _ip_bytes(src), _ip_bytes(dst)) +
+                TCP.pack(443, port, 0, 0, 0x50, 0x18, 65535, 0, 0))
+            seconds, microseconds = divmod(round(time * 1e6), 1000000)
+            file.write(PCAP_RECORD.pack(PCAP_EPOCH + seconds, microseconds,
+                                        len(headers), len(headers) + size))
+            file.write(headers)
+
+def _ip_bytes(ip):
+    return bytes(int(part) for part in ip.split('.'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generates the traffic of concurrent SVT Play video " +
+            "flows as tcpdump text output or a pcap file.")
+    parser.add_argument('-n', "--flows",
+        help="amount of concurrent flows",
+        type=int,
+        default=100)
+    parser.add_argument('-s', "--segments",
+        help="amount of segments played per flow",
+        type=int,
+        default=30)
+    parser.add_argument("--start-spread",
+        help="seconds within which the flows start",
+        type=float,
+        default=60)
+    parser.add_argument("--synthetic-videos",
+        help="play videos of a synthetic catalog of this size instead of " +
+            "the database",
+        type=int)
+    parser.add_argument("--mss",
+        help="largest packet payload in bytes",
+        type=int,
+        default=MSS)
+    parser.add_argument("--rate",
+        help="download rate of a flow in bits per second",
+        type=float,
+        default=FLOW_RATE)
+    parser.add_argument("--jitter",
+        help="largest random delay added to the gaps between segments",
+        type=float,
+        default=JITTER)
+    parser.add_argument('--seed',
+        type=int,
+        default=0)
+    parser.add_argument('-o', "--output",
+        help="file the traffic is written to, a pcap file if it ends " +
+            "with .pcap",
+        default='traffic.txt')
+    parser.add_argument("--truth",
+        help="JSON file the flows and their videos are written to",
+        default='traffic_truth.json')
+    args = parser.parse_args()
+    catalog = (synthetic.generate_catalog(args.synthetic_videos,
+                                          seed=args.seed)
+               if args.synthetic_videos else db.load_csv_db())
+    flows = generate_flows(catalog, args.flows, args.segments,
+                           args.start_spread, args.seed)
+    packets = merged_packets(catalog, flows, args.seed, mss=args.mss,
+                             rate=args.rate, jitter=args.jitter)
+    if path.splitext(args.output)[1] == '.pcap':
+        write_pcap(packets, args.output)
+    else:
+        write_text(packets, args.output)
+    with open(args.truth, 'w', encoding='utf8') as json_file:
+        json.dump([flow.truth() for flow in flows], json_file, indent=4)
+    print(f"Traffic of {len(flows)} flows written to {args.output}")
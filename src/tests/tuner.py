@@ -0,0 +1,215 @@
+"""Searches the window width, k-d tree dimension, leaf size, neighbor
+amount and Pearson's r threshold on the test data or a synthetic corpus.
+Every combination is measured for build time, index size, query
+throughput, match and false match rates and time to match. The Pareto
+front is reported and the chosen configuration is written to a config
+file for `identifier.py --config`.
+"""
+
+from identifier import db
+from utils.console import console
+from itertools import product
+from timeit import default_timer as timer
+import argparse
+import json
+import corpus
+import synthetic
+import tests
+
+# (key, whether higher is better) of the objectives of the Pareto front
+OBJECTIVES = (
+    ("Match rate", True),
+    ("False match rate", False),
+    ("Time to match", False),
+    ("Throughput", True),
+    ("Build time", False),
+    ("Index size", False))
+
+def tune(catalog, test_videos, window_widths, kd_dimensions, leaf_sizes,
+         neighbor_amounts, pearson_thresholds):
+    """Returns the measurements of every combination of the parameters."""
+    results = []
+    for window_width, kd_dimension, leaf_size in product(
+            window_widths, kd_dimensions, leaf_sizes):
+        print(f"Building window width {window_width}, k-dimension " +
+            f"{kd_dimension} and leaf size {leaf_size}...")
+        try:
+            start = timer()
+            # Without the cache every query searches the tree
+            identification_db = db.IdentificationDB(window_width,
+                kd_dimension, catalog, cache_size=0, leaf_size=leaf_size)
+            build_time = timer() - start
+        except ValueError as e:
+            print("Error:", e, "Continuing...")
+            continue
+
+        for neighbor_amount in neighbor_amounts:
+            identification_db.neighbor_amount = neighbor_amount
+            outcomes, query_times = tests.replay(test_videos,
+                identification_db, window_width, pearson_thresholds,
+                progress=False)
+            for pearson_threshold in pearson_thresholds:
+                results.append({
+                    "window_width": window_width,
+                    "k_dimension": kd_dimension,
+                    "leaf_size": leaf_size,
+                    "neighbor_amount": neighbor_amount,
+                    "pearson_threshold": pearson_threshold,
+                    **_rates(outcomes, pearson_threshold),
+                    "Throughput": (len(query_times) / sum(query_times)
+                                   if query_times else 0),
+                    "Build time": build_time,
+                    "Index size": identification_db.index_size()})
+    return results
+
+def pareto_front(results):
+    """Returns the results no other result is at least as good as in every
+    objective and better in one.
+    """
+    return [result for result in results
+            if not any(_dominates(other, result) for other in results)]
+
+def choose(front, max_false_match_rate=0.0):
+    """Returns the result with the highest match rate among those within
+    the false match rate, preferring earlier matches and then throughput.
+    """
+    candidates = [result for result in front
+                  if result["False match rate"] <= max_false_match_rate]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda result: (result["Match rate"],
+        -result["Time to match"], result["Throughput"]))
+
+def print_front(front, chosen):
+    from rich.table import Table
+    table = Table(title=f"Pareto front ({len(front)} configurations)")
+    for column in ("w", "k", "Leaf", "Neighbors", "r", "Match", "False",
+                   "To match", "Windows/s", "Build", "Index"):
+        table.add_column(column, justify='right')
+    for result in sorted(front, key=lambda result: -result["Match rate"]):
+        table.add_row(str(result["window_width"]),
+            str(result["k_dimension"]), str(result["leaf_size"]),
+            str(result["neighbor_amount"]),
+            str(result["pearson_threshold"]),
+            f"{result['Match rate'] * 100:.1f}%",
+            f"{result['False match rate'] * 100:.1f}%",
+            f"{result['Time to match']:.1f} s",
+            f"{result['Throughput']:.0f}",
+            f"{result['Build time']:.1f} s",
+            f"{result['Index size'] / 2**20:.1f} MB",
+            style='bold green' if result is chosen else None)
+    console.print(table)
+
+def _rates(outcomes, pearson_threshold):
+    matches = false_matches = 0
+    match_times = []
+    for svt_id, records, _ in outcomes.values():
+        record = tests.first_match(records, pearson_threshold)
+        if record is None:
+            continue
+        _, time, best = record
+        if best['id'] == svt_id:
+            matches += 1
+            match_times.append(time)
+        else:
+            false_matches += 1
+    tested = len(outcomes) or 1
+    return {
+        "Match rate": matches / tested,
+        "False match rate": false_matches / tested,
+        "Time to match": (sum(match_times) / len(match_times)
+                          if match_times else float('inf'))}
+
+def _dominates(result, other):
+    better = False
+    for key, higher_is_better in OBJECTIVES:
+        difference = result[key] - other[key] if higher_is_better \
+            else other[key] - result[key]
+        if difference < 0:
+            return False
+        if difference > 0:
+            better = True
+    return better
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Searches identification parameters on the SVT Play " +
+            "test data or a synthetic corpus.")
+    parser.add_argument('-w', "--window-widths",
+        type=int,
+        nargs='+',
+        default=[6, 8, 12])
+    parser.add_argument('-k', "--kd-dimensions",
+        type=int,
+        nargs='+',
+        default=[2, 3, 4, 6])
+    parser.add_argument("--leaf-sizes",
+        type=int,
+        nargs='+',
+        default=[40, 100, db.LEAF_SIZE])
+    parser.add_argument("--neighbor-amounts",
+        type=int,
+        nargs='+',
+        default=[1, 3, db.NEIGHBOR_AMOUNT, 10])
+    parser.add_argument('-p', "--pearson-thresholds",
+        type=float,
+        nargs='+',
+        default=[0.99, 0.999, 0.9999, 0.99999999])
+    parser.add_argument("--max-false-match-rate",
+        help="highest false match rate of the chosen configuration",
+        type=float,
+        default=0.0)
+    parser.add_argument("--synthetic-videos",
+        help="tune on a synthetic catalog of this size instead of the " +
+            "test data",
+        type=int)
+    parser.add_argument("--synthetic-streams",
+        help="amount of streams captured from the synthetic catalog",
+        type=int,
+        default=200)
+    parser.add_argument('--seed',
+        type=int,
+        default=0)
+    parser.add_argument('-o', "--output",
+        help="config file the chosen configuration is written to",
+        default='identifier_config.json')
+    parser.add_argument("--results",
+        help="JSON file all measurements are written to",
+        default='tuning_results.json')
+    args = parser.parse_args()
+
+    if args.synthetic_videos:
+        catalog = synthetic.generate_catalog(args.synthetic_videos,
+                                             seed=args.seed)
+        test_videos = synthetic.sample_streams(catalog,
+            args.synthetic_streams, seed=args.seed)
+    else:
+        print("Reading database file...")
+        catalog = corpus.unpack_catalog(corpus.load_catalog())
+        print("Reading test data file...")
+        test_videos = tests.load_test_videos(catalog)
+
+    results = tune(catalog, test_videos, args.window_widths,
+        args.kd_dimensions, args.leaf_sizes, args.neighbor_amounts,
+        args.pearson_thresholds)
+    front = pareto_front(results)
+    chosen = choose(front, args.max_false_match_rate)
+    print_front(front, chosen)
+
+    with open(args.results, 'w', encoding='utf8') as json_file:
+        # Without matches the time to match is infinite, null in JSON
+        json.dump({"Results": [{**result, "Time to match": None}
+                               if result["Time to match"] == float('inf')
+                               else result for result in results],
+                   "Pareto front": [results.index(result)
+                                    for result in front]},
+                  json_file, indent=4)
+    if chosen is None:
+        print("No configuration is within the false match rate, " +
+            "no config written.")
+    else:
+        config = {key: chosen[key] for key in ("window_width", "k_dimension",
+            "leaf_size", "neighbor_amount", "pearson_threshold")}
+        with open(args.output, 'w', encoding='utf8') as json_file:
+            json.dump(config, json_file, indent=4)
+        print(f"Configuration written to {args.output}")
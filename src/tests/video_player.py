@@ -8,7 +8,7 @@ import argparse
 import time
 import os
 
-def play_video(url, playback_time, exit_flag=None):
+def play_video(url, playback_time, exit_flag=None, on_start=None):
 
     os.environ['WDM_LOG'] = '0'
     options = webdriver.ChromeOptions()
@@ -16,6 +16,8 @@ def play_video(url, playback_time, exit_flag=None):
     options.add_argument('start-maximized')
     driver = webdriver.Chrome(ChromeDriverManager().install(), 
         options=options)
+    if on_start is not None:
+        on_start(driver)
     driver.get(url)
 
     # Click cookie pop-up
@@ -1,3 +1,42 @@
-from rich.console import Console
+from threading import Lock
 
-console = Console()
\ No newline at end of file
+class _LazyConsole:
+    """Creates the rich console on first use, so that importing it does not
+    load rich.
+    """
+    _console = None
+    _lock = Lock()
+
+    def __getattr__(self, name):
+        if _LazyConsole._console is None:
+            with _LazyConsole._lock:
+                if _LazyConsole._console is None:
+                    from rich.console import Console
+                    _LazyConsole._console = Console()
+        return getattr(_LazyConsole._console, name)
+
+console = _LazyConsole()
+
+class _LoggedStatus:
+    """Stands in for a rich status, logging the status and its updates."""
+    def __init__(self, status):
+        # Logged with the file and line of the caller of progress
+        console.log(status, _stack_offset=3)
+
+    def update(self, status):
+        console.log(status, _stack_offset=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+def progress(message, quiet=False):
+    """Returns console.status(message), or with quiet a stand-in logging the
+    message and its updates. Rich shows one live display at a time, so work
+    off the main thread while it shows a status has to be quiet.
+    """
+    if quiet:
+        return _LoggedStatus(message)
+    return console.status(message)
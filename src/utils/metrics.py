@@ -0,0 +1,127 @@
+"""Low overhead counters and fixed-bucket latency histograms for the
+identification hot path. Metrics register themselves in a shared registry
+which renders them in the Prometheus text format or as a console summary.
+"""
+
+from time import perf_counter
+import bisect
+
+# Upper bounds in seconds, the last bucket catches everything above
+LATENCY_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025,
+                   0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return (f"# HELP {self.name} {self.description}\n"
+                f"# TYPE {self.name} counter\n"
+                f"{self.name} {self.value}\n")
+
+class Histogram:
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        """Context manager observing the time spent inside it."""
+        return _Timer(self)
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}",
+                 f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return '\n'.join(lines) + '\n'
+
+class _Timer:
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = perf_counter()
+
+    def __exit__(self, *_):
+        self._histogram.observe(perf_counter() - self._start)
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name, description):
+        return self._register(Counter(name, description))
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, description, buckets))
+
+    def _register(self, metric):
+        # Modules may be imported more than once, e.g. as a script and as
+        # a module, keep the first registration
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format."""
+        return ''.join(metric.render() for metric in self._metrics.values())
+
+    def summary(self):
+        """Returns a table of all counters and latency percentiles."""
+        from rich.table import Table
+        table = Table(title="Metrics")
+        table.add_column("Metric")
+        table.add_column("Count", justify='right')
+        table.add_column("Mean", justify='right')
+        table.add_column("p50", justify='right')
+        table.add_column("p99", justify='right')
+        for metric in self._metrics.values():
+            if isinstance(metric, Counter):
+                table.add_row(metric.name, str(metric.value), '', '', '')
+            elif metric.count:
+                table.add_row(metric.name, str(metric.count),
+                    _format_seconds(metric.sum / metric.count),
+                    _format_seconds(metric.quantile(0.5)),
+                    _format_seconds(metric.quantile(0.99)))
+            else:
+                table.add_row(metric.name, '0', '', '', '')
+        return table
+
+def _format_seconds(seconds):
+    if seconds == float('inf'):
+        return f"> {LATENCY_BUCKETS[-1]} s"
+    return f"{seconds * 1000:.3f} ms"
+
+registry = Registry()
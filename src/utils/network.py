@@ -1,7 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from os import path
+import ipaddress
 import subprocess
 import socket
 import platform
+import json
+import time
+import os
 from utils import format
+from utils.console import console
+
+RESOLVER_THREADS = 32
+CDN_CACHE_TTL = 24 * 60 * 60
+CDN_CACHE_FILE = path.join(path.expanduser('~'), '.cache',
+                           'svtplay_cdn_ips.json')
 
 def get_packet_analyzer(capture_filter, interface,
                         tshark_dir='C:\Program Files\Wireshark\\'):
@@ -17,6 +30,7 @@ def get_packet_analyzer(capture_filter, interface,
                 "-eframe.time_relative",
                 "-eip.src",
                 "-eip.dst",
+                "-etcp.dstport",
                 "-etcp.len"
             ),
             stdout = subprocess.PIPE,
@@ -40,28 +54,144 @@ def get_packet_analyzer(capture_filter, interface,
         )
         return tcpdump
 
-def get_cdn_ips(name, start, end, char_start, char_end):
-    cdn_ips = set()
+def get_packet_reader(file_path):
+    """Returns a tcpdump process printing the packets of a pcap file like
+    get_packet_analyzer prints captured packets.
+    """
+    return subprocess.Popen(
+        (
+            "tcpdump",
+            "-r" + file_path,
+            "-q",
+            "-n",
+            "-ttttt"
+        ),
+        stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE,
+        encoding = 'utf8'
+    )
+
+def get_capture_filter(ips):
+    """Returns a capture filter for TCP packets sent from port 443 of the
+    given addresses, aggregated into as few network prefixes as possible.
+    """
+    if not ips:
+        raise ValueError("no addresses to capture from, none of the SVT " +
+            "Play CDN hostnames resolved!")
+    networks = ipaddress.collapse_addresses(
+        ipaddress.IPv4Network(ip) for ip in ips)
+    sources = ' or '.join(
+        f'src host {network.network_address}' if network.prefixlen == 32
+        else f'src net {network}' for network in networks)
+    return f'tcp src port 443 and ({sources}) and greater 0'
+
+def resolve_host(hostname):
+    """Returns the IPv4 addresses of a hostname, empty if it does not
+    resolve.
+    """
+    try:
+        return {ip[4][0] for ip in socket.getaddrinfo(hostname, 443,
+                                                      family=socket.AF_INET)}
+    except socket.gaierror:
+        return set()
+
+def resolve_all(hostnames, resolver=resolve_host,
+                max_workers=RESOLVER_THREADS):
+    """Resolves hostnames concurrently and returns all their addresses."""
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return set().union(*pool.map(resolver, hostnames))
+
+def get_cdn_hostnames(name, start, end, char_start, char_end):
+    hostnames = []
     for i in range(start, end + 1):
         if char_end:
             for j in range(char_start, char_end + 1):
-                for ip in socket.getaddrinfo(name.format(num=i, char=chr(j)),
-                        443, family=socket.AF_INET):
-                    cdn_ips.add(ip[4][0])
+                hostnames.append(name.format(num=i, char=chr(j)))
         else:
-            for ip in socket.getaddrinfo(name.format(num=i),
-                    443, family=socket.AF_INET):
-                cdn_ips.add(ip[4][0])
-    return cdn_ips
+            hostnames.append(name.format(num=i))
+    return hostnames
 
-def get_svtplay_ips(full_cdn_search=False):
+def get_cdn_ips(name, start, end, char_start, char_end,
+                resolver=resolve_host):
+    return resolve_all(get_cdn_hostnames(name, start, end, char_start,
+                                         char_end), resolver)
 
-    svtplay_ips = get_cdn_ips('ed{num}.cdn.svt.se', 0, 12, 0, 0)
+def get_svtplay_hostnames(full_cdn_search=False):
+    hostnames = get_cdn_hostnames('ed{num}.cdn.svt.se', 0, 12, 0, 0)
     if full_cdn_search:
-        svtplay_ips |= (
-            get_cdn_ips('svt-vod-{num}.secure.footprint.net', 1, 10, 0, 0) |
-            get_cdn_ips('svt-vod-{num}{char}.akamaized.net', 1, 9, 97, 116))
-    return svtplay_ips
+        hostnames += (
+            get_cdn_hostnames('svt-vod-{num}.secure.footprint.net',
+                              1, 10, 0, 0) +
+            get_cdn_hostnames('svt-vod-{num}{char}.akamaized.net',
+                              1, 9, 97, 116))
+    return hostnames
+
+def get_svtplay_ips(full_cdn_search=False, resolver=resolve_host,
+                    cache_file=CDN_CACHE_FILE, cache_ttl=CDN_CACHE_TTL,
+                    on_update=None):
+    """Returns the SVT Play CDN addresses. Addresses cached less than
+    cache_ttl seconds ago are returned immediately and refreshed in the
+    background, otherwise the addresses are resolved before returning. Pass
+    cache_file=None to always resolve. on_update is called with the returned
+    addresses before the refresh starts, and then with the refreshed
+    addresses, so the refreshed ones are always applied last.
+    """
+    hostnames = get_svtplay_hostnames(full_cdn_search)
+    cache_key = 'full' if full_cdn_search else 'default'
+
+    def resolve():
+        svtplay_ips = resolve_all(hostnames, resolver)
+        if cache_file is not None and svtplay_ips:
+            _write_cdn_cache(cache_file, cache_key, svtplay_ips)
+        return svtplay_ips
+
+    cached = _read_cdn_cache(cache_file, cache_key, cache_ttl)
+    if cached is None:
+        svtplay_ips = resolve()
+        if on_update is not None:
+            on_update(svtplay_ips)
+        return svtplay_ips
+    if on_update is not None:
+        on_update(cached)
+
+    def refresh():
+        svtplay_ips = resolve()
+        if on_update is not None and svtplay_ips:
+            on_update(svtplay_ips)
+
+    Thread(target=refresh, daemon=True).start()
+    return cached
+
+def _read_cdn_cache(cache_file, cache_key, cache_ttl):
+    if cache_file is None:
+        return None
+    try:
+        with open(cache_file, encoding='utf8') as file:
+            entry = json.load(file)[cache_key]
+    except (OSError, ValueError, KeyError):
+        return None
+    if time.time() - entry['time'] > cache_ttl:
+        return None
+    return set(entry['ips'])
+
+def _write_cdn_cache(cache_file, cache_key, svtplay_ips):
+    try:
+        with open(cache_file, encoding='utf8') as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        cache = {}
+    cache[cache_key] = {'time': time.time(), 'ips': sorted(svtplay_ips)}
+    # Write then rename so that a concurrent reader never sees half a file
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(path.dirname(cache_file) or '.', exist_ok=True)
+        with open(tmp_file, 'w', encoding='utf8') as file:
+            json.dump(cache, file)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        # The addresses are still used, only the next start resolves again
+        console.log(f"[yellow]Could not cache the CDN addresses:[/yellow] "
+                    f"{e}")
 
 def format_packet(packet):
     if platform.system() == "Windows":
@@ -78,3 +208,14 @@ def format_packet(packet):
     size = int(packet[-1])
 
     return src, dst, time, size
+
+def format_packet_with_port(packet):
+    """Returns (src, dst, destination port, time, size) of a packet, the
+    port tells apart flows between the same addresses.
+    """
+    src, dst, time, size = format_packet(packet)
+    if platform.system() == "Windows":
+        port = int(packet.strip().split("\t")[3])
+    else:
+        port = int(packet.strip().split(" ")[4].rstrip(':').split('.')[-1])
+    return src, dst, port, time, size
@@ -0,0 +1,165 @@
+"""Profiling support for the identifier and the test harness. The
+deterministic mode runs cProfile and writes pstats, the sampling mode
+periodically records the stack of the profiled thread at a low overhead and
+writes a collapsed stack file for flame graphs. Only the thread entering the
+profiler is profiled, not e.g. the thread posting events to a separate web
+interface.
+"""
+
+from utils.console import console
+from collections import Counter
+from os import path
+import cProfile
+import _thread
+import pstats
+import sys
+import threading
+
+MODES = ('deterministic', 'sampling')
+SAMPLE_INTERVAL = 0.005
+UNPROFILED_NOTE = ("Other threads, e.g. the one posting events to a " +
+    "separate web interface, are not profiled")
+
+# Time is attributed to the first category matching a frame of the stack,
+# searching from the innermost frame
+CATEGORIES = (
+    ('Packet parsing', lambda file, func: (file.endswith('network.py')
+                                           and func == 'format_packet')),
+    # Everything below publish_event, whichever output the events go to
+    ('Publishing', lambda file, func: (file.endswith(path.join(
+        'identifier', 'identifier.py')) and func == 'publish_event')),
+    ('IdentificationDB', lambda file, _: file.endswith(path.join(
+        'identifier', 'db.py'))),
+)
+
+class Sampler:
+    """Records the stack of a thread every interval seconds."""
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self.stacks = Counter()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def write_collapsed(self, file_path):
+        """Writes the samples as `frame;frame;frame count` lines."""
+        with open(file_path, 'w', encoding='utf8') as file:
+            for stack, count in self.stacks.items():
+                frames = ';'.join(f"{func} ({path.basename(file_name)})"
+                                  for file_name, func in stack)
+                file.write(f"{frames} {count}\n")
+
+    def report(self):
+        """Returns a table of the share of samples per category."""
+        from rich.table import Table
+        total = sum(self.stacks.values())
+        shares = Counter()
+        for stack, count in self.stacks.items():
+            shares[_categorize(stack)] += count
+
+        table = Table(title=f"Profile ({total} samples)",
+                      caption=UNPROFILED_NOTE)
+        table.add_column("Category")
+        table.add_column("Samples", justify='right')
+        table.add_column("Share", justify='right')
+        for category, count in shares.most_common():
+            table.add_row(category, str(count),
+                          f"{round(count / total * 100, 1)}%")
+        return table
+
+class Profiler:
+    """Context manager profiling the calling thread, writing
+    `<output>.pstats` in the deterministic mode and `<output>.collapsed` in
+    the sampling mode on exit.
+    """
+    def __init__(self, mode, output, interval=SAMPLE_INTERVAL):
+        if mode not in MODES:
+            raise ValueError(f"unknown profiling mode '{mode}', " +
+                f"choose from {', '.join(MODES)}")
+        self._mode = mode
+        self._output = output
+        # Only one of them runs, sampling would skew the cProfile timings
+        self._sampler = None
+        self._profile = None
+        if mode == 'deterministic':
+            self._profile = cProfile.Profile()
+        else:
+            self._sampler = Sampler(threading.get_ident(), interval)
+
+    def __enter__(self):
+        if self._profile is not None:
+            self._profile.enable()
+        else:
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *_):
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self._output + '.pstats')
+            console.log(f"Profile written to {self._output}.pstats")
+            console.print(self._pstats_report())
+        else:
+            self._sampler.stop()
+            self._sampler.write_collapsed(self._output + '.collapsed')
+            console.log(f"Collapsed stacks written to "
+                        f"{self._output}.collapsed")
+            console.print(self._sampler.report())
+
+    def _pstats_report(self):
+        """Returns a table of the cumulative time of the functions in each
+        category.
+        """
+        from rich.table import Table
+        stats = pstats.Stats(self._profile)
+        table = Table(title="Deterministic profile",
+                      caption=UNPROFILED_NOTE)
+        table.add_column("Category")
+        table.add_column("Function")
+        table.add_column("Calls", justify='right')
+        table.add_column("Cumulative", justify='right')
+        rows = []
+        for (file, _, func), (_, calls, _, cumulative, _) in \
+                stats.stats.items():
+            category = _categorize(((file, func),))
+            if category != 'Other':
+                rows.append((category, func, calls, cumulative))
+        for category, func, calls, cumulative in sorted(
+                rows, key=lambda row: row[3], reverse=True):
+            table.add_row(category, func, str(calls),
+                          f"{round(cumulative, 3)} s")
+        return table
+
+def stop_after(seconds):
+    """Interrupts the main thread after the given amount of seconds, ending
+    a bounded run as if CTRL-C was pressed.
+    """
+    timer = threading.Timer(seconds, _thread.interrupt_main)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+def _categorize(stack):
+    for file, func in reversed(stack):
+        for category, matches in CATEGORIES:
+            if matches(file, func):
+                return category
+    return 'Other'